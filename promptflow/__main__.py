@@ -1,11 +1,249 @@
 """Main entry point for the promptflow application."""
+import argparse
+import logging
 import os
-from promptflow.src.app import App
+from typing import Optional
+from promptflow.src.embeddings import (
+    CACHE_ENV,
+    DEFAULT_ADDRESS,
+    DEFAULT_MODEL,
+    WORKER_ENV,
+)
 from promptflow.src.state import State
 from promptflow.src.options import Options
 
 
-def main():
+def run_batch(args: argparse.Namespace):
+    """
+    Run a flowchart over a dataset without starting the GUI
+    """
+    from promptflow.src.batch import BatchRunner
+    from promptflow.src.embeddings import cached_embedder, set_embedder
+    from promptflow.src.llm_batching import CompletionBatcher, set_batcher
+    from promptflow.src.llm_cache import SQLiteCache, set_cache
+    from promptflow.src.rate_limit import Limit, RateLimiter, set_rate_limiter
+    from promptflow.src.tracing import Tracer
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("promptflow.src.batch").setLevel(logging.INFO)
+    tracer = Tracer() if args.trace else None
+    if args.cache:
+        set_cache(SQLiteCache(args.cache, ttl=args.cache_ttl))
+    if args.rpm or args.tpm:
+        set_rate_limiter(RateLimiter(default=Limit(rpm=args.rpm, tpm=args.tpm)))
+    set_embedder(cached_embedder(args.embedding_worker, args.embedding_cache))
+    if args.micro_batch > 1:
+        set_batcher(
+            CompletionBatcher(
+                max_batch_size=args.micro_batch, max_wait=args.micro_batch_wait
+            )
+        )
+    runner = BatchRunner.load(
+        args.flowchart,
+        concurrency=args.concurrency,
+        max_steps=args.max_steps,
+        max_workers=args.max_workers,
+        report_every=args.report_every,
+        tracer=tracer,
+    )
+    if args.estimate_cost:
+        print(f"Estimated Cost: {runner.cost(args.input)}")
+        return
+    stats = runner.run(args.input, args.output, resume=not args.no_resume)
+    print(stats)
+    if tracer:
+        tracer.export(args.trace)
+
+
+def run_ingest(args: argparse.Namespace):
+    """
+    Embed a file of documents into an index without starting the GUI
+    """
+    from promptflow.src.embeddings import cached_embedder, set_embedder
+    from promptflow.src.ingest import Ingester
+    from promptflow.src.nodes.embedding_node import (
+        EmbeddingsDatabaseSingleton,
+        IndexParams,
+    )
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("promptflow.src.ingest").setLevel(logging.INFO)
+    set_embedder(cached_embedder(args.embedding_worker, args.embedding_cache))
+    params = IndexParams(
+        space=args.space,
+        dim=args.dim,
+        M=args.M,
+        ef_construction=args.ef_construction,
+        max_elements=args.max_elements,
+    )
+    ingester = Ingester(
+        EmbeddingsDatabaseSingleton().collection(params=params),
+        text_field=args.text_field,
+        batch_size=args.batch_size,
+        chunk_size=args.chunk_size,
+        checkpoint_every=args.checkpoint_every,
+        num_threads=args.threads,
+    )
+    stats = ingester.run(
+        args.input,
+        args.index,
+        args.labels,
+        fields=args.fields.split(",") if args.fields else None,
+        resume=not args.no_resume,
+    )
+    print(stats)
+    print(f"Label columns: {','.join(ingester.collection.fields)}")
+
+
+def run_embedding_worker(args: argparse.Namespace):
+    """
+    Load an embedding model once and serve it to other promptflow processes
+    """
+    from promptflow.src.embeddings import cached_embedder, serve
+
+    logging.basicConfig(level=logging.INFO)
+    embedder = cached_embedder(cache_path=args.embedding_cache, model=args.model)
+    if not args.lazy:
+        embedder.encode(["warm up"])
+    serve(embedder, args.address)
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="promptflow")
+    subparsers = parser.add_subparsers(dest="command")
+    batch = subparsers.add_parser(
+        "batch", help="run a flowchart over a .jsonl or .csv file of inputs"
+    )
+    batch.add_argument("flowchart", help=".promptflow file to run")
+    batch.add_argument("input", help=".jsonl or .csv file with one state per record")
+    batch.add_argument("-o", "--output", default="results.jsonl")
+    batch.add_argument("-c", "--concurrency", type=int, default=4)
+    batch.add_argument("--max-steps", type=int, default=None)
+    batch.add_argument(
+        "--max-workers", type=int, default=1, help="threads per record's branches"
+    )
+    batch.add_argument("--report-every", type=int, default=100)
+    batch.add_argument(
+        "--trace",
+        default=None,
+        help="write node and condition timings to a .json (Chrome trace) or .jsonl file",
+    )
+    batch.add_argument(
+        "--cache",
+        default=None,
+        help="sqlite file to cache LLM completions in, shared across runs",
+    )
+    batch.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=None,
+        help="seconds before a cached completion expires",
+    )
+    batch.add_argument(
+        "--micro-batch",
+        type=int,
+        default=1,
+        help="send up to this many concurrent legacy completion prompts per request",
+    )
+    batch.add_argument(
+        "--micro-batch-wait",
+        type=float,
+        default=0.05,
+        help="seconds to wait for a micro-batch to fill",
+    )
+    batch.add_argument(
+        "--rpm", type=int, default=None, help="max OpenAI requests per minute per model"
+    )
+    batch.add_argument(
+        "--tpm", type=int, default=None, help="max OpenAI tokens per minute per model"
+    )
+    batch.add_argument(
+        "--estimate-cost",
+        action="store_true",
+        help="print the estimated cost of the dataset instead of running it",
+    )
+    batch.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="overwrite the output instead of skipping records already in it",
+    )
+    ingest = subparsers.add_parser(
+        "ingest", help="embed a .jsonl, .csv or text file of documents into an index"
+    )
+    ingest.add_argument("input", help="documents to embed")
+    ingest.add_argument("--index", default="embeddings.bin", help="index file")
+    ingest.add_argument("--labels", default="labels.csv", help="label file")
+    ingest.add_argument("--text-field", default="text", help="field to embed")
+    ingest.add_argument(
+        "--fields", default=None, help="comma separated columns of the label file"
+    )
+    ingest.add_argument("--batch-size", type=int, default=32)
+    ingest.add_argument(
+        "--chunk-size", type=int, default=1024, help="documents added at a time"
+    )
+    ingest.add_argument("--checkpoint-every", type=int, default=10_000)
+    ingest.add_argument(
+        "--threads", type=int, default=-1, help="threads adding to the index"
+    )
+    ingest.add_argument("--space", choices=["l2", "cosine", "ip"], default="l2")
+    ingest.add_argument("--dim", type=int, default=768, help="embedding size")
+    ingest.add_argument(
+        "--M", type=int, default=16, help="links per node of the HNSW graph"
+    )
+    ingest.add_argument(
+        "--ef-construction",
+        type=int,
+        default=200,
+        help="candidates considered while building the index",
+    )
+    ingest.add_argument(
+        "--max-elements",
+        type=int,
+        default=1024,
+        help="initial capacity of the index, doubled as it fills",
+    )
+    ingest.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="start a new index instead of continuing an existing one",
+    )
+    for subparser in (batch, ingest):
+        subparser.add_argument(
+            "--embedding-worker",
+            default=os.environ.get(WORKER_ENV),
+            help="host:port of an embedding worker to embed with",
+        )
+    worker = subparsers.add_parser(
+        "embedding-worker", help="serve an embedding model to other processes"
+    )
+    worker.add_argument("--address", default=DEFAULT_ADDRESS, help="host:port")
+    worker.add_argument("--model", default=DEFAULT_MODEL)
+    worker.add_argument(
+        "--lazy", action="store_true", help="load the model on the first request"
+    )
+    for subparser in (batch, ingest, worker):
+        subparser.add_argument(
+            "--embedding-cache",
+            default=os.environ.get(CACHE_ENV),
+            help="file to keep embeddings in across runs",
+        )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list[str]] = None):
+    args = parse_args(argv)
+    if args.command == "batch":
+        run_batch(args)
+        return
+    if args.command == "ingest":
+        run_ingest(args)
+        return
+    if args.command == "embedding-worker":
+        run_embedding_worker(args)
+        return
+
+    from promptflow.src.app import App
+
     state = State()
 
     if os.path.exists("promptflow/options.json"):
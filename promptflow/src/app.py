@@ -24,6 +24,7 @@ from promptflow.src.command import (
     RemoveNodeCommand,
 )
 
+from promptflow.src.batch import BatchRunner
 from promptflow.src.flowchart import Flowchart
 from promptflow.src.nodes.audio_node import ElevenLabsNode, WhispersNode
 from promptflow.src.nodes.date_node import DateNode
@@ -41,12 +42,15 @@ from promptflow.src.nodes.history_node import HistoryNode
 from promptflow.src.nodes.memory_node import (
     MemoryNode,
     WindowedMemoryNode,
+    TokenWindowedMemoryNode,
+    SummarizingMemoryNode,
     DynamicWindowedMemoryNode,
 )
 from promptflow.src.nodes.embedding_node import (
     EmbeddingInNode,
     EmbeddingQueryNode,
     EmbeddingsIngestNode,
+    fields_file,
 )
 from promptflow.src.nodes.input_node import InputNode
 from promptflow.src.nodes.test_nodes import AssertNode, LoggingNode
@@ -115,6 +119,9 @@ class App:
         self.file_menu.add_command(label="Save Flowchart...", command=self.save_as)
         self.file_menu.add_command(label="Load Flowchart...", command=self.load_from)
         self.file_menu.add_command(label="Save Console...", command=self.export_console)
+        self.file_menu.add_command(
+            label="Estimate Dataset Cost...", command=self.cost_dataset
+        )
         self.export_menu = tk.Menu(self.file_menu, tearoff=0)
         self.export_menu.add_command(label="To Mermaid", command=self.export_to_mermaid)
         self.file_menu.add_cascade(label="Export", menu=self.export_menu)
@@ -189,6 +196,18 @@ class App:
                 WindowedMemoryNode, "Windowed Memory"
             ),
         )
+        self.add_memory_menu.add_command(
+            label="Token Windowed Memory - Save to memory up to a number of tokens",
+            command=self.create_add_node_function(
+                TokenWindowedMemoryNode, "Token Windowed Memory"
+            ),
+        )
+        self.add_memory_menu.add_command(
+            label="Summarizing Memory - Summarize old messages with an LLM",
+            command=self.create_add_node_function(
+                SummarizingMemoryNode, "Summarizing Memory"
+            ),
+        )
         self.add_memory_menu.add_command(
             label="Dynamic Windowed Memory - Save to memory based on last occurance of text",
             command=self.create_add_node_function(
@@ -429,6 +448,21 @@ class App:
         self.output_console.insert(tk.INSERT, f"Estimated Cost: {cost}\n")
         self.output_console.see(tk.END)
 
+    def cost_dataset(self):
+        """Get the approx cost to run the flowchart over a batch dataset"""
+        filename = tkinter.filedialog.askopenfilename(
+            filetypes=[("Batch inputs", "*.jsonl *.csv"), ("All files", "*")]
+        )
+        if not filename:
+            self.logger.info("No dataset selected to cost")
+            return
+        self.logger.info("Getting cost of flowchart over %s", filename)
+        cost = BatchRunner(self.flowchart).cost(filename)
+        self.output_console.insert(
+            tk.INSERT, f"Estimated Cost ({os.path.basename(filename)}): {cost}\n"
+        )
+        self.output_console.see(tk.END)
+
     def run(self):
         """Run the app."""
         self.logger.info("Running app")
@@ -462,6 +496,11 @@ class App:
                         # write the embedding to the archive
                         archive.write(node.filename, arcname=node.filename)
                         archive.write(node.label_file, arcname=node.label_file)
+                        if os.path.exists(fields_file(node.filename)):
+                            archive.write(
+                                fields_file(node.filename),
+                                arcname=fields_file(node.filename),
+                            )
                 self.logger.info("Saved flowchart to %s", filename)
                 self.current_file = filename
                 self.loading_popup.destroy()
@@ -477,26 +516,9 @@ class App:
         if filename:
             self.loading_popup = self.show_loading_popup("Loading flowchart...")
             self.clear_flowchart()
-            with zipfile.ZipFile(filename, "r") as archive:
-                with archive.open("flowchart.json") as loadfile:
-                    data = json.load(loadfile)
-                    # load the embedding if there is one
-                    for node in data["nodes"]:
-                        if node["classname"] == "EmbeddingsIngestNode":
-                            # load the embedding
-                            embed_file = archive.extract(
-                                node["filename"], path=os.getcwd()
-                            )
-                            node["filename"] = embed_file
-                            # load the labels
-                            label_file = archive.extract(
-                                node["label_file"], path=os.getcwd()
-                            )
-                            node["label_file"] = label_file
-                    self.clear_flowchart()
-                    self.flowchart = Flowchart.deserialize(self.canvas, data)
-                    self.current_file = filename
-                    self.loading_popup.destroy()
+            self.flowchart = Flowchart.load(filename, self.canvas)
+            self.current_file = filename
+            self.loading_popup.destroy()
         else:
             self.logger.info("No file selected to load from")
 
@@ -532,6 +554,7 @@ class App:
                 self.save_as()
             elif dialog is None:
                 return  # don't close
+        self.flowchart.finish_run()
         self.root.destroy()
 
     def show_about(self):
@@ -0,0 +1,270 @@
+"""
+Runs one flowchart over a dataset of initial states, for evaluations
+and other offline jobs.
+"""
+from __future__ import annotations
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Iterator, Optional
+from promptflow.src.executor import Executor, HeadlessConsole
+from promptflow.src.flowchart import Flowchart
+from promptflow.src.state import State
+from promptflow.src.tracing import Tracer
+from promptflow.src.usage import UsageLedger
+
+# columns of a record that are not copied into the snapshot
+RESERVED_KEYS = ("id", "inputs", "history", "result", "snapshot")
+
+
+class BatchRecord:
+    """
+    One row of a batch: the initial state of a run, plus any
+    answers to feed to the flowchart's InputNodes in order
+    """
+
+    __slots__ = ("id", "state", "inputs")
+
+    def __init__(self, record_id: str, state: State, inputs: list[str]):
+        self.id = record_id
+        self.state = state
+        self.inputs = inputs
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any], index: int) -> BatchRecord:
+        """
+        Build from a JSONL line or CSV row.
+        A record is either a serialized State ("snapshot", "history", "result")
+        or a flat mapping whose other keys become the snapshot.
+        """
+        snapshot = dict(data.get("snapshot") or {})
+        snapshot.update(
+            {key: value for key, value in data.items() if key not in RESERVED_KEYS}
+        )
+        history = data.get("history") or []
+        if isinstance(history, str):
+            history = json.loads(history)
+        inputs = data.get("inputs") or []
+        if isinstance(inputs, str):
+            inputs = json.loads(inputs) if inputs.startswith("[") else [inputs]
+        state = State(snapshot=snapshot, history=history, result=data.get("result", ""))
+        return cls(str(data.get("id", index)), state, inputs)
+
+
+def read_records(filename: str) -> Iterator[BatchRecord]:
+    """
+    Stream records from a .jsonl or .csv file
+    """
+    with open(filename, newline="", encoding="utf-8") as infile:
+        if filename.endswith(".csv"):
+            rows: Iterator[dict[str, Any]] = csv.DictReader(infile)
+        else:
+            rows = (json.loads(line) for line in infile if line.strip())
+        for index, row in enumerate(rows):
+            yield BatchRecord.from_dict(row, index)
+
+
+def read_finished(filename: str) -> set[str]:
+    """
+    Ids of the records already written to an output file without an error.
+    Records that failed, or whose line was cut short by a crash, run again.
+    """
+    finished: set[str] = set()
+    if not os.path.exists(filename):
+        return finished
+    with open(filename, encoding="utf-8") as outfile:
+        for line in outfile:
+            try:
+                result = json.loads(line)
+                if result.get("error") is None:
+                    finished.add(result["id"])
+            except (json.JSONDecodeError, KeyError, TypeError, AttributeError):
+                continue
+    return finished
+
+
+class BatchStats:
+    """
+    Counts, timing and LLM usage for a batch run
+    """
+
+    def __init__(self):
+        self.completed = 0
+        self.errors = 0
+        self.skipped = 0
+        self.usage = UsageLedger()
+        self.start_time = time.perf_counter()
+        self.end_time: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    @property
+    def throughput(self) -> float:
+        """
+        Records finished per second
+        """
+        return self.completed / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        usage = self.usage.total
+        return (
+            f"{self.completed} records in {self.elapsed:.2f}s "
+            f"({self.throughput:.2f} records/s), "
+            f"{self.errors} errors, {self.skipped} skipped, "
+            f"{usage.total_tokens} tokens (${usage.cost:.4f})"
+        )
+
+
+class BatchRunner:
+    """
+    Loads a flowchart once and runs it over many records on a pool of
+    concurrency threads, appending one JSON line per finished record
+    to the output file as soon as it is done.
+    """
+
+    def __init__(
+        self,
+        flowchart: Flowchart,
+        concurrency: int = 4,
+        max_steps: Optional[int] = None,
+        max_workers: int = 1,
+        report_every: int = 100,
+        tracer: Optional[Tracer] = None,
+    ):
+        self.flowchart = flowchart
+        self.concurrency = concurrency
+        self.max_steps = max_steps
+        self.max_workers = max_workers
+        self.report_every = report_every
+        self.tracer = tracer
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, filename: str, **kwargs) -> BatchRunner:
+        """
+        Create a batch runner for a .promptflow file
+        """
+        return cls(Flowchart.load(filename), **kwargs)
+
+    def initialize(self, usage: Optional[UsageLedger] = None) -> State:
+        """
+        Run the InitNode subchart once; every record starts from its snapshot
+        """
+        return self._executor(HeadlessConsole(), usage).initialize(State())
+
+    def run_record(
+        self,
+        record: BatchRecord,
+        init_state: State,
+        usage: Optional[UsageLedger] = None,
+    ) -> dict[str, Any]:
+        """
+        Run the flowchart for one record and return its output line.
+        The record's LLM usage is added to usage, if given.
+        """
+        console = HeadlessConsole(record.inputs)
+        state = record.state
+        state.snapshot = init_state.snapshot | state.snapshot
+        record_usage = UsageLedger()
+        start = time.perf_counter()
+        final_state = self._executor(console, record_usage).run(state)
+        errors = [line for line in console.lines if line.startswith("[ERROR]")]
+        if usage is not None:
+            usage.merge(record_usage)
+        return {
+            "id": record.id,
+            "state": final_state.serialize(),
+            "console": console.get_text(),
+            "error": errors[0].strip() if errors else None,
+            "elapsed": time.perf_counter() - start,
+            "usage": record_usage.serialize(),
+        }
+
+    def cost(self, input_filename: str) -> float:
+        """
+        Estimated cost of running every record in input_filename.
+        Nothing is run, including the InitNode subchart.
+        """
+        return sum(
+            self.flowchart.cost(record.state) for record in read_records(input_filename)
+        )
+
+    def run(
+        self, input_filename: str, output_filename: str, resume: bool = True
+    ) -> BatchStats:
+        """
+        Run every record in input_filename, appending results to output_filename.
+        With resume, records already in the output file are skipped;
+        otherwise the output file is overwritten.
+        """
+        finished = read_finished(output_filename) if resume else set()
+        stats = BatchStats()
+        init_state = self.initialize(stats.usage)
+        mode = "a" if resume else "w"
+        with open(output_filename, mode, encoding="utf-8") as outfile:
+            # a crash may have left the last line unterminated
+            if resume and outfile.tell() > 0:
+                with open(output_filename, "rb") as check:
+                    check.seek(-1, os.SEEK_END)
+                    if check.read(1) != b"\n":
+                        outfile.write("\n")
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                pending = set()
+                for record in read_records(input_filename):
+                    if record.id in finished:
+                        stats.skipped += 1
+                        continue
+                    # keep the input streaming instead of queueing every record
+                    if len(pending) >= self.concurrency * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    future = pool.submit(
+                        self._run_and_write, record, init_state, outfile, stats
+                    )
+                    pending.add(future)
+                for future in pending:
+                    future.result()
+        self.flowchart.finish_run()
+        stats.end_time = time.perf_counter()
+        self.logger.info("Batch finished: %s", stats)
+        return stats
+
+    def _executor(
+        self, console: HeadlessConsole, usage: Optional[UsageLedger] = None
+    ) -> Executor:
+        return Executor(
+            self.flowchart,
+            console=console,
+            max_steps=self.max_steps,
+            max_workers=self.max_workers,
+            tracer=self.tracer,
+            usage=usage,
+            # nodes are finished once, after the last record
+            finish_runs=False,
+        )
+
+    def _run_and_write(
+        self, record: BatchRecord, init_state: State, outfile, stats: BatchStats
+    ):
+        try:
+            line = self.run_record(record, init_state, stats.usage)
+        except Exception as err:
+            self.logger.error(f"Error running record {record.id}: {err}")
+            line = {"id": record.id, "state": None, "console": "", "error": str(err)}
+        with self._lock:
+            # outputs that aren't JSON (e.g. objects a FuncNode returned) are written as text
+            outfile.write(json.dumps(line, default=str) + "\n")
+            outfile.flush()
+            stats.completed += 1
+            if line["error"]:
+                stats.errors += 1
+            if self.report_every and stats.completed % self.report_every == 0:
+                self.logger.info("Batch progress: %s", stats)
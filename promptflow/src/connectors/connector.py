@@ -9,6 +9,7 @@ from typing import Optional, Tuple
 
 from promptflow.src.nodes.start_node import StartNode
 from promptflow.src.serializable import Serializable
+from promptflow.src.state import State
 from promptflow.src.nodes.node_base import NodeBase
 from promptflow.src.dialogues.code_input import CodeInput
 from promptflow.src.text_data import TextData
@@ -28,7 +29,7 @@ class Connector(Serializable):
 
     def __init__(
         self,
-        canvas: tk.Canvas,
+        canvas: Optional[tk.Canvas],
         node1: NodeBase,
         node2: NodeBase,
         condition: Optional[TextData | dict] = None,
@@ -37,15 +38,7 @@ class Connector(Serializable):
         self.node1 = node1
         self.node2 = node2
         self.flowchart = node1.flowchart
-        points = self.get_points()
-        self.item = canvas.create_line(
-            points,  # type: ignore
-            fill="black",
-            width=2,
-            tags="connector",
-            arrow=tk.LAST,
-            smooth=True,
-        )
+        self.item: Optional[int] = None
         node1.output_connectors.append(self)
         node2.input_connectors.append(self)
         self.logger = logging.getLogger(__name__)
@@ -60,8 +53,24 @@ class Connector(Serializable):
             condition.text = DEFAULT_COND_TEMPLATE
         self.condition: TextData = condition
         self.condition_label: Optional[int] = None
-        self.filled_box: Optional[int] = self.create_condition_label()
+        self.filled_box: Optional[int] = None
         self.text_window: Optional[CodeInput] = None
+
+    def draw_view(self):
+        """
+        Create the line and condition label on the canvas.
+        Called by the flowchart once both nodes have been drawn.
+        """
+        points = self.get_points()
+        self.item = self.canvas.create_line(
+            points,  # type: ignore
+            fill="black",
+            width=2,
+            tags="connector",
+            arrow=tk.LAST,
+            smooth=True,
+        )
+        self.filled_box = self.create_condition_label()
         self.canvas.tag_bind(self.item, "<Button-3>", self.delete)
         self.canvas.tag_bind(self.item, "<Double-Button-1>", self.edit_condition)
         self.canvas.tag_bind(self.item, "<Button-1>", self.select)
@@ -116,15 +125,27 @@ class Connector(Serializable):
         """
         Remove the connector from the flowchart, both from the canvas and from the flowchart's list of connectors.
         """
-        if self in self.node1.flowchart.connectors:
-            self.node1.flowchart.connectors.remove(self)
+        self.flowchart.remove_connector(self)
         self.node1.output_connectors.remove(self)
         self.node2.input_connectors.remove(self)
+        if self.item is None:
+            return
         self.canvas.delete(self.item)
+        self.item = None
         if self.condition_label and self.filled_box:
             self.canvas.delete(self.condition_label)
             self.canvas.delete(self.filled_box)
 
+    def evaluate(self, state: State) -> bool:
+        """
+        Run the connector's condition against the state.
+        An empty condition always passes.
+        """
+        if not self.condition.text.strip():
+            return True
+        # evaluate condition and only follow the connector if condition is true
+        return self.condition.main()(state)
+
     def edit_condition(self, _: tk.Event):
         """
         Bring up the text input window to edit the connector's condition.
@@ -64,8 +64,8 @@ class PartialConnector:
         Check if a connector already exists between source and given
         nodes
         """
-        for connector in self.flowchart.connectors:
-            if connector.node1 == self.node and connector.node2 == node:
+        for connector in self.node.output_connectors:
+            if connector.node2 == node:
                 self.logger.debug("Connector already exists")
                 return True
         return False
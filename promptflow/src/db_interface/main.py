@@ -1,4 +1,5 @@
 import json
+import threading
 import uuid
 from typing import Any, Optional, Union
 import psycopg2
@@ -21,6 +22,8 @@ class DBInterface:
 
         self.connection = None
         self.cursor = None
+        # one cursor is shared by every node, including concurrent batch records
+        self._lock = threading.Lock()
 
     def connect(self):
         """Connect to the database."""
@@ -36,15 +39,16 @@ class DBInterface:
     def _run_query(self, query: str) -> list[tuple[Any, ...]]:
         if self.connection is None or self.cursor is None:
             raise RuntimeError("Not connected to database.")
-        try:
-            self.cursor.execute(query)
-            result = self.cursor.fetchall()
-            self.connection.commit()
-            return result
-        except Exception as e:
-            self.cursor.execute("ROLLBACK")
-            self.connection.commit()
-            return []
+        with self._lock:
+            try:
+                self.cursor.execute(query)
+                result = self.cursor.fetchall()
+                self.connection.commit()
+                return result
+            except Exception as e:
+                self.cursor.execute("ROLLBACK")
+                self.connection.commit()
+                return []
 
     def _create_temp_table(
         self, columns: list[str], types: Optional[list[str]] = None
@@ -0,0 +1,447 @@
+"""
+Text embedding models, loaded on first use rather than at import.
+A model can also be served by a local worker process, so every promptflow
+process on the machine shares one loaded copy instead of each loading its own.
+Embeddings are cached by text, so repeated texts are only encoded once.
+"""
+from __future__ import annotations
+import hashlib
+import logging
+import os
+import secrets
+import stat
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Optional
+
+import numpy as np
+
+DEFAULT_MODEL = "hkunlp/instructor-large"
+DEFAULT_ADDRESS = "localhost:6283"
+# set to a worker's host:port to use it instead of loading the model in process
+WORKER_ENV = "PROMPTFLOW_EMBEDDING_WORKER"
+# the worker and its clients authenticate with this key or, if it isn't set,
+# the key in AUTHKEY_FILE, which the worker creates readable only by its user
+AUTHKEY_ENV = "PROMPTFLOW_EMBEDDING_AUTHKEY"
+AUTHKEY_FILE = os.path.join(os.path.expanduser("~"), ".promptflow", "embedding.key")
+# set to a file to keep embeddings across runs
+CACHE_ENV = "PROMPTFLOW_EMBEDDING_CACHE"
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    """
+    host:port as a (host, port) tuple
+    """
+    host, _, port = address.rpartition(":")
+    return host or "localhost", int(port)
+
+
+def _authkey(create: bool = False) -> bytes:
+    """
+    The key shared by the worker and its clients. Connections are
+    unpickled, so there is no default: with create (the worker) a random
+    key is written to AUTHKEY_FILE if there's none yet.
+    """
+    key = os.environ.get(AUTHKEY_ENV)
+    if key:
+        return key.encode()
+    if create and not os.path.exists(AUTHKEY_FILE):
+        os.makedirs(os.path.dirname(AUTHKEY_FILE), mode=0o700, exist_ok=True)
+        try:
+            fd = os.open(AUTHKEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass  # another worker just created it
+        else:
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32))
+    if not os.path.exists(AUTHKEY_FILE):
+        raise RuntimeError(
+            f"No embedding worker key: set {AUTHKEY_ENV} or start the worker "
+            f"to create {AUTHKEY_FILE}"
+        )
+    if os.stat(AUTHKEY_FILE).st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+        raise RuntimeError(f"{AUTHKEY_FILE} must only be readable by its owner")
+    with open(AUTHKEY_FILE, encoding="utf-8") as f:
+        key = f.read().strip()
+    if not key:
+        raise RuntimeError(f"{AUTHKEY_FILE} is empty")
+    return key.encode()
+
+
+class Embedder(ABC):
+    """
+    Turns texts into vectors, one row per text. INSTRUCTOR models embed
+    each text with an instruction describing the task, e.g.
+    "Represent the question for retrieving supporting documents:"
+    """
+
+    @property
+    @abstractmethod
+    def model(self) -> str:
+        """
+        Name of the model, part of every embedding's cache key
+        """
+
+    @abstractmethod
+    def encode(
+        self, texts: list[str], batch_size: int = 32, instruction: str = ""
+    ) -> np.ndarray:
+        """
+        Embed the texts, as a float32 array with one row per text
+        """
+
+
+class InstructorEmbedder(Embedder):
+    """
+    An INSTRUCTOR model, imported and loaded the first time it encodes
+    """
+
+    def __init__(self, model: str = DEFAULT_MODEL):
+        self.model_name = model
+        self._instructor: Any = None
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def _load(self) -> Any:
+        with self._lock:
+            if self._instructor is None:
+                start = time.perf_counter()
+                # pulls in torch and transformers, so only when first needed
+                from InstructorEmbedding import INSTRUCTOR
+
+                self._instructor = INSTRUCTOR(self.model)
+                self.logger.info(
+                    "Loaded %s in %.2fs", self.model, time.perf_counter() - start
+                )
+        return self._instructor
+
+    @property
+    def model(self) -> str:
+        return self.model_name
+
+    def encode(
+        self, texts: list[str], batch_size: int = 32, instruction: str = ""
+    ) -> np.ndarray:
+        inputs: list[Any] = texts
+        if instruction:
+            inputs = [[instruction, text] for text in texts]
+        vectors = self._load().encode(inputs, batch_size=batch_size)
+        return np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+
+
+class WorkerEmbedder(Embedder):
+    """
+    Encodes with a model served by a worker (see serve), over one
+    connection per thread
+    """
+
+    def __init__(self, address: str = DEFAULT_ADDRESS, model: Optional[str] = None):
+        self.address = parse_address(address)
+        self._model = model
+        self._local = threading.local()
+
+    def _connection(self) -> Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = Client(self.address, authkey=_authkey())
+            self._local.connection = connection
+        return connection
+
+    def _call(self, *request: Any) -> Any:
+        for attempt in range(2):
+            try:
+                connection = self._connection()
+                connection.send(request)
+                status, result = connection.recv()
+                break
+            except (EOFError, OSError):
+                # the worker restarted; reconnect once
+                self._local.connection = None
+                if attempt:
+                    raise
+        if status != "ok":
+            raise RuntimeError(f"Embedding worker failed: {result}")
+        return result
+
+    @property
+    def model(self) -> str:
+        if self._model is None:
+            self._model = self._call("model")
+        return self._model
+
+    def encode(
+        self, texts: list[str], batch_size: int = 32, instruction: str = ""
+    ) -> np.ndarray:
+        return self._call("encode", texts, batch_size, instruction)
+
+
+def embedding_key(model: str, instruction: str, text: str) -> bytes:
+    """
+    Hash identifying a text's embedding by a model with an instruction
+    """
+    content = "\0".join((model, instruction, text)).encode()
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+
+class EmbeddingCache:
+    """
+    Embeddings by embedding_key. The most recently used are kept in memory;
+    with a path, every embedding is also stored on disk, as float32 rows of
+    a memory-mapped file (path) and their keys, in the same order, in
+    path.keys. Rows are written before their keys, so after a crash the
+    keys file only lists complete rows.
+
+    Only one process should write to a cache file at a time; share one
+    through an embedding worker.
+    """
+
+    MAGIC = b"PFEMBED1"
+    HEADER_SIZE = 16
+    KEY_SIZE = 16
+
+    def __init__(self, path: Optional[str] = None, hot_size: int = 10_000):
+        self.path = path
+        self.hot_size = hot_size
+        self.hits = 0
+        self.misses = 0
+        self._hot: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        self._rows: dict[bytes, int] = {}
+        self._vectors: Optional[np.memmap] = None
+        self._dim: Optional[int] = None
+        self._count = 0
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self._open()
+
+    def _open(self):
+        assert self.path is not None
+        with open(self.path, "rb") as f:
+            header = f.read(self.HEADER_SIZE)
+        if header[:8] != self.MAGIC:
+            raise ValueError(f"{self.path} is not an embedding cache")
+        self._dim = int(np.frombuffer(header[8:12], dtype=np.uint32)[0])
+        row_size = self._dim * 4
+        capacity = (os.path.getsize(self.path) - self.HEADER_SIZE) // row_size
+        self._map(capacity)
+        keys_path = self.path + ".keys"
+        keys = b""
+        if os.path.exists(keys_path):
+            with open(keys_path, "rb") as f:
+                keys = f.read()
+        count = min(len(keys) // self.KEY_SIZE, capacity)
+        for row in range(count):
+            key = keys[row * self.KEY_SIZE : (row + 1) * self.KEY_SIZE]
+            self._rows[key] = row
+        self._count = count
+        if len(keys) != count * self.KEY_SIZE:
+            # drop a partly written key
+            with open(keys_path, "r+b") as f:
+                f.truncate(count * self.KEY_SIZE)
+
+    def _map(self, capacity: int):
+        assert self.path is not None and self._dim is not None
+        self._vectors = None
+        if capacity:
+            self._vectors = np.memmap(
+                self.path,
+                dtype=np.float32,
+                mode="r+",
+                offset=self.HEADER_SIZE,
+                shape=(capacity, self._dim),
+            )
+
+    def _reserve(self, dim: int, count: int):
+        """
+        Make room on disk for count more rows, doubling the file as it fills
+        """
+        assert self.path is not None
+        if self._dim is None:
+            self._dim = dim
+            with open(self.path, "wb") as f:
+                f.write(self.MAGIC + np.uint32(dim).tobytes())
+                f.write(b"\0" * (self.HEADER_SIZE - 12))
+        elif dim != self._dim:
+            raise ValueError(
+                f"Embeddings of size {dim} don't fit cache {self.path} of size {self._dim}"
+            )
+        capacity = 0 if self._vectors is None else self._vectors.shape[0]
+        needed = self._count + count
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2, 1024)
+        if self._vectors is not None:
+            self._vectors.flush()
+        with open(self.path, "r+b") as f:
+            f.truncate(self.HEADER_SIZE + capacity * dim * 4)
+        self._map(capacity)
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        self._hot[key] = vector
+        self._hot.move_to_end(key)
+        while len(self._hot) > self.hot_size:
+            self._hot.popitem(last=False)
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._hot.get(key)
+            if vector is not None:
+                self._hot.move_to_end(key)
+            else:
+                row = self._rows.get(key)
+                if row is None:
+                    self.misses += 1
+                    return None
+                assert self._vectors is not None
+                vector = np.array(self._vectors[row])
+                self._remember(key, vector)
+            self.hits += 1
+            return vector
+
+    def put(self, keys: list[bytes], vectors: np.ndarray):
+        with self._lock:
+            new = [i for i, key in enumerate(keys) if key not in self._rows]
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector)
+            if self.path is None or not new:
+                return
+            self._reserve(vectors.shape[1], len(new))
+            assert self._vectors is not None
+            start = self._count
+            self._vectors[start : start + len(new)] = vectors[new]
+            self._vectors.flush()
+            with open(self.path + ".keys", "ab") as f:
+                f.write(b"".join(keys[i] for i in new))
+            for row, i in enumerate(new, start):
+                self._rows[keys[i]] = row
+            self._count += len(new)
+
+    def __len__(self) -> int:
+        return self._count if self.path is not None else len(self._hot)
+
+
+class CachedEmbedder(Embedder):
+    """
+    Encodes only the texts its cache doesn't have yet
+    """
+
+    def __init__(self, embedder: Embedder, cache: EmbeddingCache):
+        self.embedder = embedder
+        self.cache = cache
+
+    @property
+    def model(self) -> str:
+        return self.embedder.model
+
+    def encode(
+        self, texts: list[str], batch_size: int = 32, instruction: str = ""
+    ) -> np.ndarray:
+        model = self.model
+        keys = [embedding_key(model, instruction, text) for text in texts]
+        found = [self.cache.get(key) for key in keys]
+        # each missing text once, however often it repeats
+        missing: dict[bytes, str] = {}
+        for key, text, vector in zip(keys, texts, found):
+            if vector is None:
+                missing.setdefault(key, text)
+        encoded: dict[bytes, np.ndarray] = {}
+        if missing:
+            vectors = self.embedder.encode(
+                list(missing.values()), batch_size=batch_size, instruction=instruction
+            )
+            self.cache.put(list(missing), vectors)
+            encoded = dict(zip(missing, vectors))
+        return np.stack(
+            [
+                vector if vector is not None else encoded[key]
+                for key, vector in zip(keys, found)
+            ]
+        ).astype(np.float32, copy=False)
+
+
+def _handle(connection: Connection, embedder: Embedder, lock: threading.Lock):
+    with connection:
+        while True:
+            try:
+                request = connection.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                if request[0] == "model":
+                    result: Any = embedder.model
+                elif request[0] == "encode":
+                    # one forward pass at a time; each already uses every core
+                    with lock:
+                        result = embedder.encode(
+                            request[1], batch_size=request[2], instruction=request[3]
+                        )
+                else:
+                    raise ValueError(f"Unknown request {request[0]!r}")
+            except Exception as err:  # pylint: disable=broad-except
+                connection.send(("error", repr(err)))
+            else:
+                connection.send(("ok", result))
+
+
+def serve(embedder: Embedder, address: str = DEFAULT_ADDRESS):
+    """
+    Serve the embedder to other processes until interrupted
+    """
+    logger = logging.getLogger(__name__)
+    lock = threading.Lock()
+    with Listener(parse_address(address), authkey=_authkey(create=True)) as listener:
+        logger.info("Serving %s on %s", embedder.model, address)
+        while True:
+            try:
+                connection = listener.accept()
+            except (AuthenticationError, OSError, EOFError) as err:
+                # e.g. a client with the wrong authkey
+                logger.warning("Rejected embedding client: %s", err)
+                continue
+            threading.Thread(
+                target=_handle, args=(connection, embedder, lock), daemon=True
+            ).start()
+
+
+# process-wide embedder shared by all nodes; created on first use
+_embedder: Optional[Embedder] = None
+_embedder_lock = threading.Lock()
+
+
+def set_embedder(embedder: Optional[Embedder]):
+    """
+    Embed with this for every node in the process, or None for the default
+    """
+    global _embedder  # pylint: disable=global-statement
+    _embedder = embedder
+
+
+def cached_embedder(
+    address: Optional[str] = None,
+    cache_path: Optional[str] = None,
+    model: str = DEFAULT_MODEL,
+) -> CachedEmbedder:
+    """
+    The worker at address, or the model in process, behind a cache kept
+    in memory and, with cache_path, on disk
+    """
+    embedder = WorkerEmbedder(address) if address else InstructorEmbedder(model)
+    return CachedEmbedder(embedder, EmbeddingCache(cache_path))
+
+
+def get_embedder() -> Embedder:
+    """
+    The process-wide embedder: by default a worker if
+    PROMPTFLOW_EMBEDDING_WORKER is set, otherwise the INSTRUCTOR model in
+    process, cached on disk if PROMPTFLOW_EMBEDDING_CACHE is set
+    """
+    global _embedder  # pylint: disable=global-statement
+    with _embedder_lock:
+        if _embedder is None:
+            _embedder = cached_embedder(
+                os.environ.get(WORKER_ENV), os.environ.get(CACHE_ENV)
+            )
+        return _embedder
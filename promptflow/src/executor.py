@@ -0,0 +1,382 @@
+"""
+Runs flowcharts without a GUI, so they can be executed from
+server processes and batch jobs.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from typing import Any, Callable, ContextManager, Iterable, Optional
+from promptflow.src.flowchart import Flowchart
+from promptflow.src.nodes.node_base import NodeBase
+from promptflow.src.state import Choices, State
+from promptflow.src.streaming import ConsoleSink, OutputSink, output_to
+from promptflow.src.usage import UsageLedger, record_to
+from promptflow.src.tracing import Tracer, annotate
+
+
+class HeadlessConsole:
+    """
+    Stand-in for the GUI console when no Tk window exists.
+    Collects everything written to it and feeds queued input to InputNodes.
+    """
+
+    def __init__(self, inputs: Optional[Iterable[str]] = None):
+        self.lines: list[str] = []
+        self.inputs: deque[str] = deque(inputs or [])
+
+    def insert(self, _: str, text: str):
+        """
+        Record text written to the console; mirrors tk.Text.insert
+        """
+        self.lines.append(text)
+
+    def see(self, _: str):
+        """
+        Nothing to scroll; mirrors tk.Text.see
+        """
+
+    def get_input(self, label: str) -> Optional[str]:
+        """
+        Return the next queued input, or None when there is none left,
+        which ends the run just like cancelling the input dialog.
+        """
+        if not self.inputs:
+            return None
+        return self.inputs.popleft()
+
+    def get_text(self) -> str:
+        """
+        Everything written to the console so far
+        """
+        return "".join(self.lines)
+
+
+class Executor:
+    """
+    Runs a flowchart against a State without any Tk objects.
+
+    Nodes that become ready in the same step (e.g. siblings fanning out of
+    one node) run concurrently on a pool of max_workers threads. Each branch
+    gets its own copy of the state; branches that reach the same node in the
+    same step are joined with the merge policy before that node runs.
+    A node returning branching Choices gives each child its own choice.
+
+    The a-prefixed methods do the same on an asyncio event loop using each
+    node's arun_subclass.
+
+    Pass a Tracer to record a span for every node run and condition evaluated,
+    output sinks to receive the text of streaming nodes as it arrives, and a
+    UsageLedger to add up the tokens and dollars each LLM node spends.
+
+    Once a run ends, every node's finish_run is called so it can save
+    buffered work; with finish_runs off the caller does that itself,
+    e.g. once after a whole batch rather than after every record.
+    """
+
+    def __init__(
+        self,
+        flowchart: Flowchart,
+        console: Optional[HeadlessConsole] = None,
+        max_steps: Optional[int] = None,
+        max_workers: int = 1,
+        merge: Callable[[list[State]], State] = State.merge,
+        tracer: Optional[Tracer] = None,
+        sinks: Optional[Iterable[OutputSink]] = None,
+        usage: Optional[UsageLedger] = None,
+        finish_runs: bool = True,
+    ):
+        self.flowchart = flowchart
+        self.console = console or HeadlessConsole()
+        self.max_steps = max_steps
+        self.max_workers = max_workers
+        self.merge = merge
+        self.tracer = tracer
+        self.sinks: list[OutputSink] = list(sinks or [])
+        self.usage = usage
+        self.finish_runs = finish_runs
+        self.is_running = False
+        self.logger = logging.getLogger(__name__)
+
+    @classmethod
+    def load(cls, filename: str, **kwargs) -> Executor:
+        """
+        Create an executor for a .promptflow file
+        """
+        return cls(Flowchart.load(filename), **kwargs)
+
+    def write(self, text: str):
+        """
+        Write a line to the console
+        """
+        self.console.insert("end", text + "\n")
+        self.console.see("end")
+
+    def initialize(self, state: Optional[State] = None) -> State:
+        """
+        Run the InitNode subchart, if it hasn't been run yet
+        """
+        state = state or State()
+        init_node = self.flowchart.init_node
+        if not init_node or init_node.run_once:
+            self.write("\n[System: Already initialized]")
+            return state
+        return self.run_from(init_node, state)
+
+    def run(self, state: Optional[State] = None) -> State:
+        """
+        Given a state, run the flowchart from the start node and update the state
+        """
+        return self.run_from(self.flowchart.start_node, state or State())
+
+    def stop(self):
+        """
+        Stop the run after the current step finishes
+        """
+        self.is_running = False
+
+    def run_node(self, node: NodeBase, state: State) -> Optional[str]:
+        """
+        Run a single node against its branch's state
+        """
+        self.logger.info(f"Running node {node.label}")
+        with self._node_span(node, state), output_to(self.sinks), record_to(self.usage):
+            before_result = node.before(state, self.console)
+            output = node.run_node(before_result, state, self.console)
+            annotate(output_size=len(str(output)) if output is not None else 0)
+        return output
+
+    def next_nodes(self, node: NodeBase, state: State) -> list[NodeBase]:
+        """
+        Return the nodes to run next: the children the plan says always
+        follow this node, plus those whose connector condition passes
+        """
+        children, conditional = self.flowchart.plan.children(node)
+        children = children.copy()
+        for connector in conditional:
+            try:
+                with self._edge_span(connector):
+                    cond = connector.evaluate(state)
+                    annotate(result=bool(cond))
+            except Exception as node_err:
+                self.logger.error(f"Error evaluating condition: {node_err}")
+                self.write(f"[ERROR]{node.label}: {node_err}")
+                break
+            self.logger.info(f"Condition {connector.condition} evaluated to {cond}")
+            if cond and connector.node2 not in children:
+                children.append(connector.node2)
+                self.logger.info(f"Added node {connector.node2.label} to queue")
+        return children
+
+    def run_from(self, node: NodeBase, state: State) -> State:
+        """
+        Run the flowchart starting at the given node until there
+        is nothing left to run, a node returns None, or the run is stopped.
+        Returns the (merged) state of the branches that ran last.
+        """
+        self.logger.info("Running flowchart from %s", node.label)
+        self.is_running = True
+        if self.max_workers > 1:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                return self._run_steps(node, state, pool)
+        return self._run_steps(node, state, None)
+
+    async def arun_node(self, node: NodeBase, state: State) -> Optional[str]:
+        """
+        Run a single node against its branch's state on the event loop
+        """
+        self.logger.info(f"Running node {node.label}")
+        with self._node_span(node, state), output_to(self.sinks), record_to(self.usage):
+            before_result = node.before(state, self.console)
+            output = await node.arun_node(before_result, state, self.console)
+            annotate(output_size=len(str(output)) if output is not None else 0)
+        return output
+
+    async def ainitialize(self, state: Optional[State] = None) -> State:
+        """
+        Async version of initialize
+        """
+        state = state or State()
+        init_node = self.flowchart.init_node
+        if not init_node or init_node.run_once:
+            self.write("\n[System: Already initialized]")
+            return state
+        return await self.arun_from(init_node, state)
+
+    async def arun(self, state: Optional[State] = None) -> State:
+        """
+        Async version of run; many runs can be in flight on one event loop
+        """
+        return await self.arun_from(self.flowchart.start_node, state or State())
+
+    async def arun_from(self, node: NodeBase, state: State) -> State:
+        """
+        Async version of run_from. Branches ready in the same step are
+        awaited together instead of using the thread pool.
+        """
+        self.logger.info("Running flowchart from %s", node.label)
+        self.is_running = True
+        ready: list[tuple[NodeBase, State]] = [(node, state)]
+        finished: list[State] = []
+        steps = 0
+        while ready:
+            ready = self._limit_step(ready, steps, finished)
+            if not ready:
+                break
+            steps += len(ready)
+            outputs = await asyncio.gather(
+                *(self.arun_node(cur_node, branch) for cur_node, branch in ready),
+                return_exceptions=True,
+            )
+            ready = self._finish_step(ready, outputs, finished)
+        return self._finish_run(finished, state)
+
+    def _node_span(self, node: NodeBase, state: State) -> ContextManager:
+        if self.tracer is None:
+            return nullcontext()
+        return self.tracer.span(
+            node.label,
+            "node",
+            node_id=node.id,
+            classname=node.__class__.__name__,
+            input_size=len(str(state.result)),
+        )
+
+    def _edge_span(self, connector) -> ContextManager:
+        if self.tracer is None:
+            return nullcontext()
+        return self.tracer.span(
+            f"{connector.node1.label} -> {connector.node2.label}",
+            "edge",
+            classname="Connector",
+            condition=connector.condition.label,
+        )
+
+    def _run_steps(
+        self, node: NodeBase, state: State, pool: Optional[ThreadPoolExecutor]
+    ) -> State:
+        ready: list[tuple[NodeBase, State]] = [(node, state)]
+        finished: list[State] = []
+        steps = 0
+        while ready:
+            ready = self._limit_step(ready, steps, finished)
+            if not ready:
+                break
+            steps += len(ready)
+            outputs = self._run_step(ready, pool)
+            ready = self._finish_step(ready, outputs, finished)
+        return self._finish_run(finished, state)
+
+    def _run_step(
+        self, ready: list[tuple[NodeBase, State]], pool: Optional[ThreadPoolExecutor]
+    ) -> list[Any]:
+        """
+        Run the nodes of one step, returning each output or the exception raised
+        """
+        if pool is None or len(ready) == 1:
+            outputs: list[Any] = []
+            for cur_node, branch in ready:
+                try:
+                    outputs.append(self.run_node(cur_node, branch))
+                except Exception as node_err:
+                    outputs.append(node_err)
+                    break
+            return outputs
+        futures = [
+            pool.submit(self.run_node, cur_node, branch) for cur_node, branch in ready
+        ]
+        wait(futures)
+        return [future.exception() or future.result() for future in futures]
+
+    def _limit_step(
+        self,
+        ready: list[tuple[NodeBase, State]],
+        steps: int,
+        finished: list[State],
+    ) -> list[tuple[NodeBase, State]]:
+        """
+        Return the nodes allowed to run this step; none if the run was
+        stopped or ran out of steps
+        """
+        if not self.is_running:
+            self.write("\n[System: Stopped]")
+            finished.extend(branch for _, branch in ready)
+            return []
+        if self.max_steps is not None:
+            if steps >= self.max_steps:
+                self.logger.info("Reached max steps (%s), stopping", self.max_steps)
+                finished.extend(branch for _, branch in ready)
+                return []
+            return ready[: self.max_steps - steps]
+        return ready
+
+    def _streamed_to_console(self, node: NodeBase) -> bool:
+        """
+        Whether the node's output was already printed as it streamed
+        """
+        streamed = False
+        for sink in self.sinks:
+            if isinstance(sink, ConsoleSink) and sink.pop_streamed(node):
+                streamed = streamed or sink.console is self.console
+        return streamed
+
+    def _finish_step(
+        self,
+        ready: list[tuple[NodeBase, State]],
+        outputs: list[Any],
+        finished: list[State],
+    ) -> list[tuple[NodeBase, State]]:
+        """
+        Report the step's outputs and work out which nodes run next
+        """
+        # children reached this step, each with the branches that reached it
+        joins: dict[NodeBase, list[State]] = {}
+        step_start = len(finished)
+        # a node returning None stops the run; every branch of the step ends here
+        done = any(output is None for output in outputs)
+        for (cur_node, branch), output in zip(ready, outputs):
+            if isinstance(output, BaseException):
+                self.logger.error(f"Error running node {cur_node.label}: {output}")
+                self.write(f"[ERROR]{cur_node.label}: {output}")
+                self.is_running = False
+                # every branch of the step ends here, each once
+                del finished[step_start:]
+                finished.extend(branch for _, branch in ready)
+                return []
+            if not self._streamed_to_console(cur_node):
+                self.write(f"{cur_node.label}: {output}")
+            self.logger.info(f"Node {cur_node.label} output: {output}")
+
+            if output is None:
+                self.logger.info(
+                    f"Node {cur_node.label} output is None, stopping execution"
+                )
+            if done:
+                finished.append(branch)
+                continue
+
+            children = self.next_nodes(cur_node, branch)
+            if not children:
+                finished.append(branch)
+            for i, child in enumerate(children):
+                # fork the state for every branch beyond the first
+                child_branch = branch if i == 0 else branch.copy()
+                if isinstance(output, Choices) and output.branch and output:
+                    choice = output[i % len(output)]
+                    child_branch.result = choice
+                    child_branch.snapshot[cur_node.label] = choice
+                joins.setdefault(child, []).append(child_branch)
+
+        if done:
+            return []
+        return [(child, self.merge(branches)) for child, branches in joins.items()]
+
+    def _finish_run(self, finished: list[State], state: State) -> State:
+        if self.is_running:
+            self.write("\n[System: Done]")
+        self.is_running = False
+        if self.finish_runs:
+            self.flowchart.finish_run()
+        return self.merge(finished or [state])
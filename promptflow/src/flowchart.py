@@ -6,35 +6,19 @@ import logging
 import tkinter as tk
 import tkinter.scrolledtext
 import threading
+import uuid
 from queue import Queue
 from typing import Any, Optional
+from promptflow.src.graph import Graph, node_class
+from promptflow.src.plan import ExecutionPlan
 from promptflow.src.nodes.node_base import NodeBase
 from promptflow.src.nodes.start_node import InitNode, StartNode
-from promptflow.src.nodes.input_node import InputNode
-from promptflow.src.nodes.func_node import FuncNode
-from promptflow.src.nodes.llm_node import LLMNode
-from promptflow.src.nodes.date_node import DateNode
-from promptflow.src.nodes.random_number import RandomNode
-from promptflow.src.nodes.history_node import HistoryNode
-from promptflow.src.nodes.dummy_llm_node import DummyNode
-from promptflow.src.nodes.prompt_node import PromptNode
-from promptflow.src.nodes.memory_node import (
-    MemoryNode,
-    WindowedMemoryNode,
-    DynamicWindowedMemoryNode,
-)
-from promptflow.src.nodes.embedding_node import (
-    EmbeddingInNode,
-    EmbeddingQueryNode,
-    EmbeddingsIngestNode,
-)
-from promptflow.src.nodes.test_nodes import AssertNode
-from promptflow.src.nodes.env_node import EnvNode, ManualEnvNode
-from promptflow.src.nodes.audio_node import WhispersNode, ElevenLabsNode
 from promptflow.src.connectors.connector import Connector
 from promptflow.src.connectors.partial_connector import PartialConnector
 from promptflow.src.state import State
+from promptflow.src.streaming import BufferedSink, output_to
 from promptflow.src.text_data import TextData
+from promptflow.src.usage import UsageLedger, record_to
 
 
 class Flowchart:
@@ -42,10 +26,17 @@ class Flowchart:
     Holds the nodes and connectors of a flowchart.
     """
 
-    def __init__(self, canvas: tk.Canvas, init_nodes: bool = True):
+    def __init__(self, canvas: Optional[tk.Canvas] = None, init_nodes: bool = True):
         self.canvas = canvas
         self.nodes: list[NodeBase] = []
         self.connectors: list[Connector] = []
+        # indexes kept in sync by add_node/remove_node; a node's input and
+        # output connectors are its adjacency lists
+        self.nodes_by_id: dict[str, NodeBase] = {}
+        self.start_nodes: list[StartNode] = []
+        self.init_nodes: list[InitNode] = []
+        self._queued: set[NodeBase] = set()
+        self._plan: Optional[ExecutionPlan] = None
         self.text_data_registry: dict[str, TextData] = {}
         self.logger = logging.getLogger(__name__)
 
@@ -53,32 +44,53 @@ class Flowchart:
         self._partial_connector: Optional[PartialConnector] = None
         self.is_dirty = False
         self.is_running = False
+        # tokens and dollars the LLM nodes spent in the current or last run
+        self.usage = UsageLedger()
 
         if init_nodes:
             self.add_node(InitNode(self, 70, 100, "Init"))
             self.add_node(StartNode(self, 70, 300, "Start"))
 
     @classmethod
-    def deserialize(cls, canvas: tk.Canvas, data: dict[str, Any]):
+    def deserialize(cls, canvas: Optional[tk.Canvas], data: dict[str, Any]):
         """
         Deserialize a flowchart from a dict onto a canvas
+        Pass canvas=None for a headless flowchart
+        """
+        return cls.from_graph(Graph.from_dict(data), canvas)
+
+    @classmethod
+    def from_graph(cls, graph: Graph, canvas: Optional[tk.Canvas] = None):
+        """
+        Build the flowchart's nodes and connectors from a Graph.
+        Node classes are only imported if the graph uses them.
         """
         flowchart = cls(canvas, init_nodes=False)
-        for node_data in data["nodes"]:
-            node = eval(node_data["classname"]).deserialize(flowchart, node_data)
+        for graph_node in graph.nodes.values():
+            node = node_class(graph_node.classname).deserialize(
+                flowchart, graph_node.serialize()
+            )
             flowchart.add_node(node)
-        for connector_data in data["connectors"]:
-            node1 = flowchart.find_node(connector_data["node1"])
-            node2 = flowchart.find_node(connector_data["node2"])
+        nodes = flowchart.nodes_by_id
+        for edge in graph.edges:
             connector = Connector(
-                canvas, node1, node2, connector_data.get("condition", "")
+                canvas, nodes[edge.node1.id], nodes[edge.node2.id], edge.condition
             )
             flowchart.add_connector(connector)
         flowchart.reset_node_colors()
-        canvas.update()
+        if canvas is not None:
+            canvas.update()
         flowchart.is_dirty = False
         return flowchart
 
+    @classmethod
+    def load(cls, filename: str, canvas: Optional[tk.Canvas] = None) -> Flowchart:
+        """
+        Read a .promptflow archive and deserialize the flowchart,
+        extracting any embedding files it carries into the working directory
+        """
+        return cls.from_graph(Graph.load(filename), canvas)
+
     @property
     def selected_element(self) -> Optional[NodeBase | Connector]:
         """
@@ -89,6 +101,9 @@ class Flowchart:
     @selected_element.setter
     def selected_element(self, elem: Optional[NodeBase | Connector]):
         self.logger.info("Selected element changed to %s", elem.label if elem else None)
+        if self.canvas is None:
+            self._selected_element = elem
+            return
         # deselect previous node
         if self._selected_element:
             # configure to have solid border
@@ -103,46 +118,61 @@ class Flowchart:
         """
         Find and return the node with the class StartNode
         """
-        start_nodes = [node for node in self.nodes if isinstance(node, StartNode)]
-        if len(start_nodes) == 0:
+        if len(self.start_nodes) == 0:
             raise ValueError("No start node found")
 
-        if len(start_nodes) == 1:
-            return start_nodes[0]
+        if len(self.start_nodes) == 1:
+            return self.start_nodes[0]
 
-        # sort by number of input connectors
-        start_nodes.sort(key=lambda node: len(node.input_connectors))
-        return start_nodes[0]
+        # pick the one with the fewest input connectors
+        return min(self.start_nodes, key=lambda node: len(node.input_connectors))
 
     @property
     def init_node(self) -> Optional[InitNode]:
         """
         Find and returns the single-run InitNode
         """
-        try:
-            return [node for node in self.nodes if isinstance(node, InitNode)][0]
-        except IndexError:
-            return None
+        return self.init_nodes[0] if self.init_nodes else None
+
+    @property
+    def plan(self) -> ExecutionPlan:
+        """
+        The compiled execution plan; rebuilt after the graph or a condition changes
+        """
+        if self._plan is None:
+            self._plan = ExecutionPlan.compile(self)
+        return self._plan
 
     def find_node(self, node_id: str) -> NodeBase:
         """
         Given a node uuid, find and return the node
         """
-        for node in self.nodes:
-            if node.id == node_id:
-                return node
-        raise ValueError(f"No node with id {node_id} found")
+        try:
+            return self.nodes_by_id[node_id]
+        except KeyError as err:
+            raise ValueError(f"No node with id {node_id} found") from err
 
     def add_node(self, node: NodeBase):
         """
         Safely insert a node into the flowchart
         """
-        while node in self.nodes:
+        if node.id in self.nodes_by_id:
             self.logger.debug("Duplicate node found, adding (copy) to label...")
-            node.label += " (copy)"
+            node.id = str(uuid.uuid4())
+            labels = {other.label for other in self.nodes}
+            while node.label in labels:
+                node.label += " (copy)"
+        if self.canvas is not None and not node.is_drawn:
+            node.draw_view()
         self.nodes.append(node)
+        self.nodes_by_id[node.id] = node
+        if isinstance(node, StartNode):
+            self.start_nodes.append(node)
+        elif isinstance(node, InitNode):
+            self.init_nodes.append(node)
         self.selected_element = node
         self.is_dirty = True
+        self._plan = None
 
     def add_connector(self, connector: Connector):
         """
@@ -150,9 +180,12 @@ class Flowchart:
         """
         # check for duplicate connectors
         self.logger.debug(f"Adding connector {connector}")
+        if self.canvas is not None and connector.item is None:
+            connector.draw_view()
         self.connectors.append(connector)
         self.selected_element = connector
         self.is_dirty = True
+        self._plan = None
 
     def initialize(
         self, state: State, console: tkinter.scrolledtext.ScrolledText
@@ -166,10 +199,19 @@ class Flowchart:
             console.insert(tk.END, "\n[System: Already initialized]\n")
             console.see(tk.END)
             return state
-        queue: list[NodeBase] = Queue()
-        queue.put(init_node)
+        queue: Queue[NodeBase] = Queue()
+        self._queued = set()
+        self._enqueue(queue, init_node)
         return self.run(state, console, queue)
 
+    def _enqueue(self, queue: Queue[NodeBase], node: NodeBase):
+        """
+        Queue a node to run, unless it is already waiting to run
+        """
+        if node not in self._queued:
+            self._queued.add(node)
+            queue.put(node)
+
     def run(
         self,
         state: State,
@@ -182,10 +224,13 @@ class Flowchart:
         self.logger.info("Running flowchart")
         if not queue:
             queue = Queue()
-            queue.put(self.start_node)
+            self._queued = set()
+            self.usage = UsageLedger()
+            self._enqueue(queue, self.start_node)
             self.is_running = True
         if queue.empty() and not self.is_running:
-            queue.put(self.start_node)
+            self.usage = UsageLedger()
+            self._enqueue(queue, self.start_node)
             self.is_running = True
         state = state or State()
 
@@ -195,23 +240,32 @@ class Flowchart:
                 console.insert(tk.END, "\n[System: Stopped]\n")
                 console.see(tk.END)
                 self.is_running = False
+                self.finish_run()
                 return state
             cur_node: NodeBase = queue.get()
+            self._queued.discard(cur_node)
             # turn node light yellow while running
             cur_node.canvas.itemconfig(cur_node.item, fill="#ffffcc")
             cur_node.canvas.update()
             self.logger.info(f"Running node {cur_node.label}")
             before_result = cur_node.before(state, console)
+            # streamed output is written to the console from this thread
+            sink = BufferedSink()
             try:
                 thread = threading.Thread(
-                    target=cur_node.run_node,
-                    args=(before_result, state, console),
+                    target=self._run_node_streaming,
+                    args=(cur_node, before_result, state, console, sink),
                     daemon=True,
                 )
                 thread.start()
+                # keep the UI responsive without spinning on the event loop
                 while thread.is_alive():
                     self.canvas.update()
-                thread.join()
+                    thread.join(0.05)
+                    streamed = sink.drain()
+                    if streamed:
+                        console.insert(tk.END, streamed)
+                        console.see(tk.END)
                 output = state.result
             except Exception as node_err:
                 self.logger.error(f"Error running node {cur_node.label}: {node_err}")
@@ -220,9 +274,13 @@ class Flowchart:
                         tk.END, f"[ERROR]{cur_node.label}: {node_err}" + "\n"
                     )
                     console.see(tk.END)
+                self.finish_run()
                 return state
             if console:
-                console.insert(tk.END, f"{cur_node.label}: {output}" + "\n")
+                if sink.streamed:
+                    console.insert(tk.END, sink.drain() + "\n")
+                else:
+                    console.insert(tk.END, f"{cur_node.label}: {output}" + "\n")
                 console.see(tk.END)
             self.logger.info(f"Node {cur_node.label} output: {output}")
             # turn node light green
@@ -234,47 +292,57 @@ class Flowchart:
                     f"Node {cur_node.label} output is None, stopping execution"
                 )
                 self.reset_node_colors()
-                console.insert(tk.END, "\n[System: Done]\n")
-                console.see(tk.END)
+                self._write_done(console)
+                self.finish_run()
                 return state
 
             for connector in cur_node.output_connectors:
-                if connector.condition.text.strip():
-                    # evaluate condition and only add node2 to queue if condition is true
-                    exec(
-                        connector.condition.text.strip(),
-                        dict(globals()),
-                        state.snapshot,
-                    )
-                    try:
-                        cond = state.snapshot["main"](state)  # type: ignore
-                    except Exception as node_err:
-                        self.logger.error(f"Error evaluating condition: {node_err}")
-                        if console:
-                            console.insert(
-                                tk.END, f"[ERROR]{cur_node.label}: {node_err}" + "\n"
-                            )
-                            console.see(tk.END)
-                        break
-                    self.logger.info(
-                        f"Condition {connector.condition} evaluated to {cond}"
-                    )
-                else:
-                    cond = True
+                try:
+                    cond = connector.evaluate(state)
+                except Exception as node_err:
+                    self.logger.error(f"Error evaluating condition: {node_err}")
+                    if console:
+                        console.insert(
+                            tk.END, f"[ERROR]{cur_node.label}: {node_err}" + "\n"
+                        )
+                        console.see(tk.END)
+                    break
+                self.logger.info(f"Condition {connector.condition} evaluated to {cond}")
                 if cond:
-                    # if connector.node2 not in queue:
-                    if queue.queue.count(connector.node2) == 0:
-                        queue.put(connector.node2)
+                    if connector.node2 not in self._queued:
+                        self._enqueue(queue, connector.node2)
                         self.canvas.master.after(0, self.run, state, console, queue)
                     self.logger.info(f"Added node {connector.node2.label} to queue")
 
         if queue.empty():
             self.reset_node_colors()
-            console.insert(tk.END, "\n[System: Done]\n")
-            console.see(tk.END)
+            self._write_done(console)
             self.is_running = False
+            self.finish_run()
             return state
 
+    def _run_node_streaming(
+        self,
+        node: NodeBase,
+        before_result: Any,
+        state: State,
+        console: tkinter.scrolledtext.ScrolledText,
+        sink: BufferedSink,
+    ):
+        with output_to([sink]), record_to(self.usage):
+            node.run_node(before_result, state, console)
+
+    def _write_done(self, console: tkinter.scrolledtext.ScrolledText):
+        console.insert(tk.END, "\n[System: Done]\n")
+        total = self.usage.total
+        if total.calls:
+            console.insert(
+                tk.END,
+                f"[System: {total.total_tokens} tokens in {total.calls} LLM calls, "
+                f"${total.cost:.4f}]\n",
+            )
+        console.see(tk.END)
+
     def begin_add_connector(self, node: NodeBase):
         """
         Start adding a connector from the given node.
@@ -303,42 +371,67 @@ class Flowchart:
         """
         Remove a node and all connectors connected to it.
         """
-        self.logger.info("Removing node {node}")
-        if node in self.nodes:
+        self.logger.info(f"Removing node {node}")
+        if self.nodes_by_id.pop(node.id, None) is not None:
             self.nodes.remove(node)
+        if node in self.start_nodes:
+            self.start_nodes.remove(node)
+        if node in self.init_nodes:
+            self.init_nodes.remove(node)
         # remove all connectors connected to this node
-        for other_node in self.nodes:
-            for connector in other_node.connectors:
-                if connector.node1 == node or connector.node2 == node:
-                    connector.delete()
-                    if connector in other_node.input_connectors:
-                        other_node.input_connectors.remove(connector)
-                    if connector in other_node.output_connectors:
-                        other_node.output_connectors.remove(connector)
-        for connector in self.connectors:
-            if connector.node1 == node or connector.node2 == node:
-                connector.delete()
+        # each delete detaches the connector from both of its nodes
+        while node.connectors:
+            node.connectors[0].delete()
         self.is_dirty = True
+        self._plan = None
+
+    def remove_connector(self, connector: Connector):
+        """
+        Forget a connector; compares by identity since connectors
+        with the same endpoints and condition are equal
+        """
+        for i, other in enumerate(self.connectors):
+            if other is connector:
+                del self.connectors[i]
+                self._plan = None
+                return
 
     def clear(self):
         """
         Clear the flowchart.
         """
         self.logger.info("Clearing")
-        for node in self.nodes:
+        for node in list(self.nodes):
             node.delete()
         self.nodes = []
-        for connector in self.connectors:
+        self.nodes_by_id = {}
+        self.start_nodes = []
+        self.init_nodes = []
+        for connector in list(self.connectors):
             connector.delete()
         self.connectors = []
-        self.canvas.delete("all")
-        self.canvas.update()
+        if self.canvas is not None:
+            self.canvas.delete("all")
+            self.canvas.update()
         self.is_dirty = True
+        self._plan = None
+
+    def finish_run(self):
+        """
+        Let every node know the run has ended
+        """
+        for node in self.nodes:
+            try:
+                node.finish_run()
+            except Exception as node_err:
+                self.logger.error(f"Error finishing node {node.label}: {node_err}")
 
     def reset_node_colors(self):
         """
         Set all node colors to their default color.
         """
+        if self.canvas is None:
+            return
         for node in self.nodes:
             self.canvas.itemconfig(node.item, fill=node.node_color)
 
@@ -349,13 +442,17 @@ class Flowchart:
         if text_data.label:
             self.logger.debug(f"Registering text data {text_data.label}")
             self.text_data_registry[text_data.label] = text_data
+        # conditions may have changed
+        self._plan = None
 
     def cost(self, state: State):
         """
         Return the cost of the flowchart.
+        Nodes are priced in the order they run, so each LLM node sees the
+        prompt and history the nodes before it would have left in the state.
         """
         cost = 0
-        for node in self.nodes:
+        for node in self.plan.order:
             cost += node.cost(state)
         return cost
 
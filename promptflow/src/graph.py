@@ -0,0 +1,185 @@
+"""
+Lightweight runtime representation of a flowchart.
+Loads the topology of a .promptflow file without importing
+any node classes or creating any widgets.
+"""
+from __future__ import annotations
+import importlib
+import json
+import os
+import uuid
+import zipfile
+from typing import Any, Optional
+
+# classname -> module that defines it; imported only when first needed
+NODE_MODULES: dict[str, str] = {
+    "InitNode": "promptflow.src.nodes.start_node",
+    "StartNode": "promptflow.src.nodes.start_node",
+    "InputNode": "promptflow.src.nodes.input_node",
+    "FuncNode": "promptflow.src.nodes.func_node",
+    "LLMNode": "promptflow.src.nodes.llm_node",
+    "DummyNode": "promptflow.src.nodes.dummy_llm_node",
+    "DateNode": "promptflow.src.nodes.date_node",
+    "RandomNode": "promptflow.src.nodes.random_number",
+    "HistoryNode": "promptflow.src.nodes.history_node",
+    "PromptNode": "promptflow.src.nodes.prompt_node",
+    "MemoryNode": "promptflow.src.nodes.memory_node",
+    "WindowedMemoryNode": "promptflow.src.nodes.memory_node",
+    "TokenWindowedMemoryNode": "promptflow.src.nodes.memory_node",
+    "SummarizingMemoryNode": "promptflow.src.nodes.memory_node",
+    "DynamicWindowedMemoryNode": "promptflow.src.nodes.memory_node",
+    "EmbeddingInNode": "promptflow.src.nodes.embedding_node",
+    "EmbeddingQueryNode": "promptflow.src.nodes.embedding_node",
+    "EmbeddingsIngestNode": "promptflow.src.nodes.embedding_node",
+    "AssertNode": "promptflow.src.nodes.test_nodes",
+    "LoggingNode": "promptflow.src.nodes.test_nodes",
+    "EnvNode": "promptflow.src.nodes.env_node",
+    "ManualEnvNode": "promptflow.src.nodes.env_node",
+    "WhispersNode": "promptflow.src.nodes.audio_node",
+    "ElevenLabsNode": "promptflow.src.nodes.audio_node",
+    "HttpNode": "promptflow.src.nodes.http_node",
+    "RegexNode": "promptflow.src.nodes.regex_node",
+    "TagNode": "promptflow.src.nodes.regex_node",
+    "PGMLNode": "promptflow.src.nodes.db_node",
+    "SelectNode": "promptflow.src.nodes.db_node",
+    "GenerateNode": "promptflow.src.nodes.db_node",
+}
+
+
+def node_class(classname: str) -> type:
+    """
+    Import and return the node class with the given name
+    """
+    try:
+        module = NODE_MODULES[classname]
+    except KeyError as err:
+        raise ValueError(f"Unknown node class {classname}") from err
+    return getattr(importlib.import_module(module), classname)
+
+
+class GraphNode:
+    """
+    A node's id, class and configuration, plus the edges touching it
+    """
+
+    __slots__ = ("id", "classname", "label", "config", "input_edges", "output_edges")
+
+    def __init__(self, node_id: str, classname: str, label: str, config: dict):
+        self.id = node_id
+        self.classname = classname
+        self.label = label
+        self.config = config
+        self.input_edges: list[GraphEdge] = []
+        self.output_edges: list[GraphEdge] = []
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> GraphNode:
+        """
+        Build from a node entry of flowchart.json
+        """
+        config = {
+            key: value
+            for key, value in data.items()
+            if key not in ("id", "classname", "label")
+        }
+        return cls(data["id"], data["classname"], data["label"], config)
+
+    def serialize(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "label": self.label,
+            "classname": self.classname,
+        } | self.config
+
+    def __repr__(self) -> str:
+        return f"GraphNode({self.classname}, {self.label!r})"
+
+
+class GraphEdge:
+    """
+    A directed edge between two nodes and its (serialized) condition
+    """
+
+    __slots__ = ("node1", "node2", "condition")
+
+    def __init__(self, node1: GraphNode, node2: GraphNode, condition: Any):
+        self.node1 = node1
+        self.node2 = node2
+        self.condition = condition
+
+    def serialize(self) -> dict[str, Any]:
+        return {
+            "node1": self.node1.id,
+            "node2": self.node2.id,
+            "condition": self.condition,
+        }
+
+    def __repr__(self) -> str:
+        return f"GraphEdge({self.node1.label!r} -> {self.node2.label!r})"
+
+
+class Graph:
+    """
+    Nodes (by id) and edges of a flowchart, with no GUI attached
+    """
+
+    __slots__ = ("nodes", "edges")
+
+    def __init__(self):
+        self.nodes: dict[str, GraphNode] = {}
+        self.edges: list[GraphEdge] = []
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> Graph:
+        """
+        Build from the contents of flowchart.json
+        """
+        graph = cls()
+        for node_data in data["nodes"]:
+            node = GraphNode.from_dict(node_data)
+            if node.id in graph.nodes:
+                # older files can repeat an id; connectors keep the first node
+                node.id = str(uuid.uuid4())
+                labels = {other.label for other in graph.nodes.values()}
+                while node.label in labels:
+                    node.label += " (copy)"
+            graph.nodes[node.id] = node
+        for connector_data in data["connectors"]:
+            try:
+                node1 = graph.nodes[connector_data["node1"]]
+                node2 = graph.nodes[connector_data["node2"]]
+            except KeyError as err:
+                raise ValueError(f"No node with id {err.args[0]} found") from err
+            edge = GraphEdge(node1, node2, connector_data.get("condition", ""))
+            node1.output_edges.append(edge)
+            node2.input_edges.append(edge)
+            graph.edges.append(edge)
+        return graph
+
+    @classmethod
+    def load(cls, filename: str, extract_to: Optional[str] = None) -> Graph:
+        """
+        Read a .promptflow archive, extracting any embedding files it carries
+        """
+        extract_to = extract_to or os.getcwd()
+        with zipfile.ZipFile(filename, "r") as archive:
+            with archive.open("flowchart.json") as loadfile:
+                data = json.load(loadfile)
+            # load the embedding if there is one
+            for node in data["nodes"]:
+                if node["classname"] == "EmbeddingsIngestNode":
+                    # load the label columns, if saved with the embedding
+                    fields = node["filename"] + ".fields.json"
+                    if fields in archive.namelist():
+                        archive.extract(fields, extract_to)
+                    # load the embedding
+                    node["filename"] = archive.extract(node["filename"], extract_to)
+                    # load the labels
+                    node["label_file"] = archive.extract(node["label_file"], extract_to)
+        return cls.from_dict(data)
+
+    def serialize(self) -> dict[str, Any]:
+        return {
+            "nodes": [node.serialize() for node in self.nodes.values()],
+            "connectors": [edge.serialize() for edge in self.edges],
+        }
@@ -0,0 +1,212 @@
+"""
+Chat history that remembers how many tokens its messages take up,
+so it can be measured and trimmed without re-tokenizing every turn.
+"""
+from __future__ import annotations
+from bisect import bisect_left
+from typing import Any, Callable, Iterable, SupportsIndex
+
+from promptflow.src.tokens import message_tokens
+
+
+def format_message(message: dict[str, str]) -> str:
+    """
+    A message as a line of a plain-text transcript
+    """
+    return f"{message['role']}: {message['content']}"
+
+
+class History(list):
+    """
+    A list of chat messages ({"role": ..., "content": ...}) that caches,
+    per model, the running total of tokens up to each message, and the
+    plain-text transcript of its messages.
+
+    Searches for the last message matching a predicate are cached the same
+    way, so only messages appended since the last search are checked.
+
+    Appending only costs counting the new messages; dropping messages
+    from the front keeps every count. Other changes to the list recount
+    from the first message changed. Messages themselves are treated as
+    immutable: replace a message instead of editing it in place.
+    """
+
+    def __init__(self, messages: Iterable[dict[str, str]] = ()):
+        super().__init__(messages)
+        # model -> totals, where totals[i] - totals[0] is the tokens of self[:i]
+        self._totals: dict[str, list[int]] = {}
+        self._transcript = ""
+        self._transcribed = 0
+        # search key -> (messages searched, index of the last match or -1)
+        self._matches: dict[str, tuple[int, int]] = {}
+
+    def _changed(self, start: int = 0):
+        """
+        Forget cached values from message start onwards
+        """
+        for totals in self._totals.values():
+            del totals[start + 1 :]
+        if start < self._transcribed:
+            self._transcript = ""
+            self._transcribed = 0
+        self._matches = {
+            key: found for key, found in self._matches.items() if found[0] <= start
+        }
+
+    def _dropped_front(self, count: int):
+        """
+        The first count messages were removed and the rest kept their order
+        """
+        for totals in self._totals.values():
+            del totals[: min(count, len(totals) - 1)]
+        self._transcript = ""
+        self._transcribed = 0
+        # a match that was dropped was the last one in what had been searched
+        self._matches = {
+            key: (max(searched - count, 0), max(match - count, -1))
+            for key, (searched, match) in self._matches.items()
+        }
+
+    def _index(self, index: SupportsIndex) -> int:
+        index = index.__index__()
+        return max(index + len(self), 0) if index < 0 else index
+
+    def __setitem__(self, key: Any, value: Any):
+        start = self._index(key) if not isinstance(key, slice) else 0
+        super().__setitem__(key, value)
+        self._changed(start)
+
+    def __delitem__(self, key: Any):
+        if isinstance(key, slice) and not key.start and key.step in (None, 1):
+            count = len(range(*key.indices(len(self))))
+            super().__delitem__(key)
+            self._dropped_front(count)
+            return
+        start = self._index(key) if not isinstance(key, slice) else 0
+        super().__delitem__(key)
+        self._changed(start)
+
+    def __getitem__(self, key: Any) -> Any:
+        if not isinstance(key, slice):
+            return super().__getitem__(key)
+        history = History(super().__getitem__(key))
+        start, stop, step = key.indices(len(self))
+        if step == 1 and start < stop:
+            # a contiguous slice keeps the counts of its messages
+            history._totals = {
+                model: totals[start : stop + 1]
+                for model, totals in self._totals.items()
+                if len(totals) > start
+            }
+        return history
+
+    def __iadd__(self, messages: Iterable[dict[str, str]]) -> History:  # type: ignore
+        self.extend(messages)
+        return self
+
+    def __imul__(self, count: SupportsIndex) -> History:  # type: ignore
+        super().__imul__(count)
+        self._changed()
+        return self
+
+    def insert(self, index: SupportsIndex, message: dict[str, str]):
+        start = min(self._index(index), len(self))
+        super().insert(index, message)
+        self._changed(start)
+
+    def pop(self, index: SupportsIndex = -1) -> dict[str, str]:
+        start = self._index(index)
+        message = super().pop(index)
+        if start == 0:
+            self._dropped_front(1)
+        else:
+            self._changed(start)
+        return message
+
+    def remove(self, message: dict[str, str]):
+        start = self.index(message)
+        super().remove(message)
+        self._changed(start)
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        super().reverse()
+        self._changed()
+
+    def copy(self) -> History:
+        history = History(self)
+        history._totals = {model: totals[:] for model, totals in self._totals.items()}
+        history._transcript = self._transcript
+        history._transcribed = self._transcribed
+        history._matches = self._matches.copy()
+        return history
+
+    def totals(self, model: str) -> list[int]:
+        """
+        Running token totals for the model, counting only new messages
+        """
+        totals = self._totals.setdefault(model, [0])
+        for message in super().__getitem__(slice(len(totals) - 1, None)):
+            totals.append(totals[-1] + message_tokens(model, message))
+        return totals
+
+    def tokens(self, model: str) -> int:
+        """
+        Tokens the messages take up in a chat request to the model,
+        excluding the tokens that prime the reply
+        """
+        totals = self.totals(model)
+        return totals[-1] - totals[0]
+
+    def window_start(self, model: str, max_tokens: int) -> int:
+        """
+        Index of the first message of the longest tail of the history
+        that fits in max_tokens
+        """
+        totals = self.totals(model)
+        return bisect_left(totals, totals[-1] - max_tokens)
+
+    def trim(self, model: str, max_tokens: int) -> History:
+        """
+        Drop the oldest messages until the rest fit in max_tokens
+        """
+        start = self.window_start(model, max_tokens)
+        if start:
+            del self[:start]
+        return self
+
+    def transcript(self) -> str:
+        """
+        The messages as "role: content" lines, extended as messages are appended
+        """
+        new_lines = [
+            format_message(message)
+            for message in super().__getitem__(slice(self._transcribed, None))
+        ]
+        if new_lines:
+            if self._transcribed:
+                new_lines.insert(0, self._transcript)
+            self._transcript = "\n".join(new_lines)
+            self._transcribed = len(self)
+        return self._transcript
+
+    def rfind(self, key: str, predicate: Callable[[dict[str, str]], Any]) -> int:
+        """
+        Index of the last message the predicate is true for, or -1.
+        The result is cached under key, which must identify the predicate:
+        later calls only check messages appended since.
+        """
+        searched, match = self._matches.get(key, (0, -1))
+        for index in range(len(self) - 1, searched - 1, -1):
+            if predicate(super().__getitem__(index)):
+                match = index
+                break
+        self._matches[key] = (len(self), match)
+        return match
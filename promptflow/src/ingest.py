@@ -0,0 +1,160 @@
+"""
+Bulk loading of documents into the embeddings database. Documents are
+streamed from a file, embedded in batches and added to the index a chunk
+at a time, and the index and labels are saved at checkpoints rather than
+after every document.
+"""
+from __future__ import annotations
+import csv
+import itertools
+import json
+import logging
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Iterator, Optional
+
+if TYPE_CHECKING:
+    from promptflow.src.nodes.embedding_node import EmbeddingCollection
+
+
+def read_documents(filename: str) -> Iterator[dict[str, Any]]:
+    """
+    Stream documents from a .jsonl or .csv file, or one per line of any
+    other text file (as {"text": line})
+    """
+    with open(filename, newline="", encoding="utf-8") as infile:
+        if filename.endswith(".csv"):
+            yield from csv.DictReader(infile)
+        elif filename.endswith(".jsonl"):
+            for line in infile:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for line in infile:
+                if line.strip():
+                    yield {"text": line.rstrip("\n")}
+
+
+class IngestStats:
+    """
+    Counts and timing for an ingest
+    """
+
+    def __init__(self):
+        self.documents = 0
+        self.skipped = 0
+        self.checkpoints = 0
+        self.start_time = time.perf_counter()
+        self.end_time: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    @property
+    def throughput(self) -> float:
+        """
+        Documents added per second
+        """
+        return self.documents / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.documents} documents in {self.elapsed:.2f}s "
+            f"({self.throughput:.2f} documents/s), {self.skipped} skipped, "
+            f"{self.checkpoints} checkpoints"
+        )
+
+
+class Ingester:
+    """
+    Embeds the documents of a file into a collection. While one chunk is
+    being added to the index (itself spread over num_threads), the next
+    is being embedded. Every checkpoint_every documents the index is saved
+    and the new labels are appended to the label file, so an interrupted
+    ingest can resume from its last checkpoint.
+    """
+
+    def __init__(
+        self,
+        collection: "EmbeddingCollection",
+        text_field: str = "text",
+        batch_size: int = 32,
+        chunk_size: int = 1024,
+        checkpoint_every: int = 10_000,
+        num_threads: int = -1,
+    ):
+        self.collection = collection
+        self.text_field = text_field
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.checkpoint_every = checkpoint_every
+        self.num_threads = num_threads
+        self.logger = logging.getLogger(__name__)
+
+    def run(
+        self,
+        input_filename: str,
+        index_filename: str,
+        label_filename: str,
+        fields: Optional[list[str]] = None,
+        resume: bool = True,
+    ) -> IngestStats:
+        """
+        Ingest every document of input_filename. With resume and an existing
+        index, documents already in it are skipped; otherwise the index and
+        label file are started over. fields are the columns written to the
+        label file, by default the text field followed by the first
+        document's other fields.
+        """
+        stats = IngestStats()
+        documents = read_documents(input_filename)
+        if resume and os.path.exists(index_filename):
+            # without fields, those saved with the index; refuses if there are none
+            self.collection.load(index_filename, label_filename, fields)
+            stats.skipped = len(self.collection.content_index)
+            documents = itertools.islice(documents, stats.skipped, None)
+        else:
+            first = next(documents, None)
+            if first is None:
+                return stats
+            if fields is None:
+                fields = [self.text_field] + [
+                    key for key in first if key != self.text_field
+                ]
+            documents = itertools.chain([first], documents)
+            self.collection.start(index_filename, label_filename, fields)
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest") as adder:
+            adding: Optional[Future] = None
+            since_checkpoint = 0
+            while True:
+                chunk = list(itertools.islice(documents, self.chunk_size))
+                if not chunk:
+                    break
+                vectors = self.collection.encode(
+                    [str(document[self.text_field]) for document in chunk],
+                    batch_size=self.batch_size,
+                )
+                if adding is not None:
+                    adding.result()
+                since_checkpoint += len(chunk)
+                checkpoint = since_checkpoint >= self.checkpoint_every
+                if checkpoint:
+                    since_checkpoint = 0
+                adding = adder.submit(self._add, chunk, vectors, checkpoint, stats)
+            if adding is not None:
+                adding.result()
+        self.collection.checkpoint()
+        stats.checkpoints += 1
+        stats.end_time = time.perf_counter()
+        self.logger.info("Ingest finished: %s", stats)
+        return stats
+
+    def _add(self, chunk: list[dict[str, Any]], vectors, checkpoint: bool, stats):
+        self.collection.add(chunk, vectors, num_threads=self.num_threads)
+        stats.documents += len(chunk)
+        if checkpoint:
+            self.collection.checkpoint()
+            stats.checkpoints += 1
+            self.logger.info("Ingest progress: %s", stats)
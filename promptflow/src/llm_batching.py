@@ -0,0 +1,158 @@
+"""
+Micro-batching for the legacy completion endpoint, which accepts a list
+of prompts: concurrent calls with the same settings are sent as one request.
+"""
+from __future__ import annotations
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+import openai
+
+from promptflow.src.llm_cache import request_key
+from promptflow.src.rate_limit import get_rate_limiter, limited
+
+
+class _Batch:
+    __slots__ = ("params", "prompts", "futures", "deadline")
+
+    def __init__(self, params: dict[str, Any], deadline: float):
+        self.params = params
+        self.prompts: list[str] = []
+        self.futures: list[Future] = []
+        self.deadline = deadline
+
+
+class CompletionBatcher:
+    """
+    Collects completion requests for up to max_wait seconds and sends
+    those with identical settings (model, temperature, ...) together, up to
+    max_batch_size prompts per request. Each caller gets back a response
+    holding only its own choices.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int = 20,
+        max_wait: float = 0.05,
+        create: Optional[Callable[..., Any]] = None,
+        max_concurrent_requests: int = 4,
+    ):
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be at least 1, got {max_batch_size}")
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.create = create or (lambda **request: openai.Completion.create(**request))
+        self.max_concurrent_requests = max_concurrent_requests
+        self._batches: dict[str, _Batch] = {}
+        self._cond = threading.Condition()
+        self._worker: Optional[threading.Thread] = None
+        self._senders: Optional[ThreadPoolExecutor] = None
+
+    def submit(self, **request: Any) -> dict[str, Any]:
+        """
+        Same as openai.Completion.create, but may share a request with other callers
+        """
+        if not isinstance(request.get("prompt"), str):
+            return self.create(**request)
+        return self._enqueue(request).result()
+
+    async def asubmit(self, **request: Any) -> dict[str, Any]:
+        """
+        Async version of submit; batches together with sync callers
+        """
+        if not isinstance(request.get("prompt"), str):
+            return await asyncio.to_thread(self.create, **request)
+        return await asyncio.wrap_future(self._enqueue(request))
+
+    def _enqueue(self, request: dict[str, Any]) -> Future:
+        params = {key: value for key, value in request.items() if key != "prompt"}
+        key = request_key(params)
+        future: Future = Future()
+        with self._cond:
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = self._batches[key] = _Batch(
+                    params, time.monotonic() + self.max_wait
+                )
+            batch.prompts.append(request["prompt"])
+            batch.futures.append(future)
+            self._start()
+            if len(batch.prompts) >= self.max_batch_size:
+                del self._batches[key]
+                self._send(batch)
+            self._cond.notify()
+        return future
+
+    def _start(self):
+        if self._worker is None:
+            self._senders = ThreadPoolExecutor(
+                max_workers=self.max_concurrent_requests,
+                thread_name_prefix="completion-batch",
+            )
+            self._worker = threading.Thread(target=self._flush_loop, daemon=True)
+            self._worker.start()
+
+    def _flush_loop(self):
+        """
+        Send each batch once its oldest request has waited max_wait
+        """
+        with self._cond:
+            while True:
+                if not self._batches:
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                for key, batch in list(self._batches.items()):
+                    if batch.deadline <= now:
+                        del self._batches[key]
+                        self._send(batch)
+                if self._batches:
+                    next_deadline = min(b.deadline for b in self._batches.values())
+                    self._cond.wait(max(next_deadline - now, 0))
+
+    def _send(self, batch: _Batch):
+        self._senders.submit(self._request, batch)  # type: ignore
+
+    def _request(self, batch: _Batch):
+        try:
+            create = limited(self.create, get_rate_limiter())
+            response = create(prompt=batch.prompts, **batch.params)
+        except Exception as err:  # pylint: disable=broad-except
+            for future in batch.futures:
+                future.set_exception(err)
+            return
+        # choices for prompt i are at indexes i*n .. i*n + n - 1
+        n = batch.params.get("n", 1)
+        choices = sorted(response["choices"], key=lambda choice: choice["index"])
+        for i, future in enumerate(batch.futures):
+            own_choices = choices[i * n : (i + 1) * n]
+            for index, choice in enumerate(own_choices):
+                choice["index"] = index
+            future.set_result(
+                {
+                    "choices": own_choices,
+                    "model": response.get("model"),
+                    # usage is only known for the whole request
+                    "batch_size": len(batch.prompts),
+                    "batch_usage": response.get("usage"),
+                }
+            )
+
+
+# process-wide batcher used for legacy completions; None sends each request alone
+_batcher: Optional[CompletionBatcher] = None
+
+
+def set_batcher(batcher: Optional[CompletionBatcher]):
+    """
+    Batch legacy completion requests from all LLM nodes, or None to stop
+    """
+    global _batcher  # pylint: disable=global-statement
+    _batcher = batcher
+
+
+def get_batcher() -> Optional[CompletionBatcher]:
+    return _batcher
@@ -0,0 +1,211 @@
+"""
+Caches LLM completions by their full request, so identical requests
+(common in regression runs and temperature-0 flows) skip the API.
+"""
+from __future__ import annotations
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from promptflow.src.tracing import annotate
+
+
+def request_key(request: dict[str, Any]) -> str:
+    """
+    Canonical hash of a request: the same arguments in any order give the same key
+    """
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class CompletionCache(ABC):
+    """
+    Storage for completion responses, keyed by request_key
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[dict[str, Any]]:
+        """
+        Return the cached response, or None on a miss
+        """
+
+    @abstractmethod
+    def set(self, key: str, response: dict[str, Any]):
+        """
+        Store a response, evicting old entries if needed
+        """
+
+    @abstractmethod
+    def clear(self):
+        """
+        Drop every entry
+        """
+
+
+class LRUCache(CompletionCache):
+    """
+    In-memory cache that evicts the least recently used response
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[dict[str, Any]]:
+        with self._lock:
+            response = self._entries.get(key)
+            if response is not None:
+                self._entries.move_to_end(key)
+            return response
+
+    def set(self, key: str, response: dict[str, Any]):
+        with self._lock:
+            self._entries[key] = response
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteCache(CompletionCache):
+    """
+    On-disk cache shared across runs and processes.
+    Entries older than ttl seconds are ignored and removed; past max_entries
+    the least recently used entries are evicted.
+    """
+
+    def __init__(
+        self,
+        filename: str = "promptflow_cache.sqlite",
+        ttl: Optional[float] = None,
+        max_entries: int = 100_000,
+    ):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS completions_accessed "
+                "ON completions (accessed)"
+            )
+
+    def get(self, key: str) -> Optional[dict[str, Any]]:
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT response, created FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            response, created = row
+            if self.ttl is not None and now - created > self.ttl:
+                self._conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                return None
+            self._conn.execute(
+                "UPDATE completions SET accessed = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(response)
+
+    def set(self, key: str, response: dict[str, Any]):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                (key, json.dumps(response), now, now),
+            )
+            if self.ttl is not None:
+                self._conn.execute(
+                    "DELETE FROM completions WHERE created < ?", (now - self.ttl,)
+                )
+            self._conn.execute(
+                "DELETE FROM completions WHERE key IN ("
+                "SELECT key FROM completions ORDER BY accessed DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM completions")
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+
+# process-wide cache used by nodes that have caching turned on; None disables it
+_cache: Optional[CompletionCache] = None
+
+
+def set_cache(cache: Optional[CompletionCache]):
+    """
+    Set the cache used by all LLM nodes, or None to turn caching off
+    """
+    global _cache  # pylint: disable=global-statement
+    _cache = cache
+
+
+def get_cache() -> Optional[CompletionCache]:
+    return _cache
+
+
+def cached_create(
+    create: Callable[..., Any],
+    request: dict[str, Any],
+    cache: Optional[CompletionCache],
+) -> dict[str, Any]:
+    """
+    Return the cached response to the request, or call create and cache it
+    """
+    if cache is None:
+        return create(**request)
+    key = request_key(request)
+    response = cache.get(key)
+    if response is not None:
+        annotate(cached=True)
+        return response | {"cached": True}
+    response = create(**request)
+    cache.set(key, response)
+    return response
+
+
+async def acached_create(
+    acreate: Callable[..., Awaitable[Any]],
+    request: dict[str, Any],
+    cache: Optional[CompletionCache],
+) -> dict[str, Any]:
+    """
+    Async version of cached_create
+    """
+    if cache is None:
+        return await acreate(**request)
+    key = request_key(request)
+    response = cache.get(key)
+    if response is not None:
+        annotate(cached=True)
+        return response | {"cached": True}
+    response = await acreate(**request)
+    cache.set(key, response)
+    return response
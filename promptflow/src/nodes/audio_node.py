@@ -2,18 +2,24 @@
 Handles all audio-related nodes
 """
 from abc import ABC
+import asyncio
 import os
 from typing import Any, Optional
 import wave
 import tkinter as tk
 import customtkinter
+import aiohttp
 import openai
 import elevenlabs
+from elevenlabs.api import Voice
+from elevenlabs.api.base import api_base_url_v1
+from elevenlabs.simple import is_voice_id
 import numpy as np
 import sounddevice as sd
 from promptflow.src.dialogues.node_options import NodeOptions
 from promptflow.src.dialogues.text_input import TextInput
 from promptflow.src.nodes.node_base import NodeBase
+from promptflow.src.rate_limit import get_rate_limiter
 from promptflow.src.state import State
 from promptflow.src.text_data import TextData
 
@@ -27,12 +33,13 @@ class AudioInputInterface(customtkinter.CTkToplevel):
     Popup window for recording audio
     """
 
+    filename: str = "out.wav"
+
     def __init__(self, master):
         super().__init__(master)
         self.title("Audio Input")
         self.recording = False
         self.audio_data = []
-        self.filename = "out.wav"
         self.elapsed_time = 0
 
         self.time_label = customtkinter.CTkLabel(self, text="0:00")
@@ -142,6 +149,9 @@ class AudioInputNode(AudioNode, ABC):
     data: Optional[list[float]] = None
 
     def before(self, state: State, console: tk.scrolledtext.ScrolledText) -> Any:
+        if self.canvas is None:
+            # can't record without a window; reuse the last recording
+            return
         self.audio_input_interface = AudioInputInterface(self.canvas)
         self.canvas.wait_window(self.audio_input_interface)
         self.data = self.audio_input_interface.audio_data
@@ -173,6 +183,10 @@ class WhispersNode(AudioInputNode):
         self.prompt = kwargs.get(
             "prompt", TextData("Whisper Prompt", "", self.flowchart)
         )
+        self.text_window: Optional[TextInput] = None
+
+    def draw_view(self):
+        super().draw_view()
         self.prompt_item = self.canvas.create_text(
             self.center_x,
             self.center_y + 30,
@@ -183,7 +197,6 @@ class WhispersNode(AudioInputNode):
         )
         self.items.extend([self.prompt_item])
         self.canvas.tag_bind(self.prompt_item, "<Double-Button-1>", self.edit_options)
-        self.text_window: Optional[TextInput] = None
         self.bind_drag()
         self.bind_mouseover()
 
@@ -206,9 +219,30 @@ class WhispersNode(AudioInputNode):
         self, before_result: Any, state, console: tk.scrolledtext.ScrolledText
     ) -> str:
         super().run_subclass(before_result, state, console)
-        transcript = openai.Audio.translate(
-            "whisper-1", open(self.audio_input_interface.filename, "rb")
+        filename = (
+            self.audio_input_interface.filename
+            if self.audio_input_interface
+            else AudioInputInterface.filename
+        )
+        limiter = get_rate_limiter()
+        if limiter:
+            limiter.acquire("whisper-1")
+        transcript = openai.Audio.translate("whisper-1", open(filename, "rb"))
+        return transcript["text"]
+
+    async def arun_subclass(
+        self, before_result: Any, state, console: tk.scrolledtext.ScrolledText
+    ) -> str:
+        filename = (
+            self.audio_input_interface.filename
+            if self.audio_input_interface
+            else AudioInputInterface.filename
         )
+        limiter = get_rate_limiter()
+        if limiter:
+            await limiter.aacquire("whisper-1")
+        with open(filename, "rb") as audio_file:
+            transcript = await openai.Audio.atranslate("whisper-1", audio_file)
         return transcript["text"]
 
     def cost(self, state):
@@ -247,11 +281,46 @@ class ElevenLabsNode(AudioOutputNode):
         self, before_result: Any, state, console: tk.scrolledtext.ScrolledText
     ) -> str:
         audio = elevenlabs.generate(
-            text=state.result, voice="Bella", model="eleven_monolingual_v1"
+            text=state.result, voice=self.voice, model=self.model
         )
         elevenlabs.play(audio)
         return state.result
 
+    async def arun_subclass(
+        self, before_result: Any, state, console: tk.scrolledtext.ScrolledText
+    ) -> str:
+        """
+        Requests the speech over aiohttp; looking up the voice and playing the
+        audio stay in worker threads since elevenlabs only has a blocking client
+        """
+        voice = await asyncio.to_thread(self.find_voice)
+        async with aiohttp.ClientSession(
+            headers={"xi-api-key": elevenlabs.get_api_key() or ""}
+        ) as session:
+            async with session.post(
+                f"{api_base_url_v1}/text-to-speech/{voice.voice_id}",
+                json={
+                    "text": state.result,
+                    "model_id": self.model,
+                    "voice_settings": voice.settings.dict() if voice.settings else None,
+                },
+            ) as response:
+                response.raise_for_status()
+                audio = await response.read()
+        await asyncio.to_thread(elevenlabs.play, audio)
+        return state.result
+
+    def find_voice(self) -> Voice:
+        """
+        Resolve the configured voice name (or id) to an elevenlabs Voice
+        """
+        if is_voice_id(self.voice):
+            return Voice(voice_id=self.voice)
+        for voice in elevenlabs.voices():
+            if voice.name == self.voice:
+                return voice
+        raise ValueError(f"Voice '{self.voice}' not found.")
+
     def edit_options(self, event):
         self.options_popup = NodeOptions(
             self.canvas,
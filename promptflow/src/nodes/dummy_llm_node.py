@@ -31,3 +31,9 @@ class DummyNode(LLMNode):
 
     def _completion(self, prompt: str, state: State) -> str:
         return self.dummy_string
+
+    async def _achat_completion(self, prompt: str, state: State) -> str:
+        return self.dummy_string
+
+    async def _acompletion(self, prompt: str, state: State) -> str:
+        return self.dummy_string
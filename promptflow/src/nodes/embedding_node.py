@@ -3,53 +3,388 @@ Interact with word embeddings
 """
 import logging
 import csv
+import json
 import os
+import threading
 from abc import ABC
 import tkinter
-from typing import TYPE_CHECKING, Any, List, Optional
-import time
-import hnswlib
+from typing import TYPE_CHECKING, Any, Iterator, List, Optional
 
 import numpy as np
 import openai
-from InstructorEmbedding import INSTRUCTOR
 
 from promptflow.src.dialogues.multi_file import MultiFileInput
 from promptflow.src.dialogues.node_options import NodeOptions
+from promptflow.src.embeddings import get_embedder
 
-from promptflow.src.state import State
+from promptflow.src.state import Choices, State
 from promptflow.src.nodes.node_base import NodeBase
 from promptflow.src.themes import monokai
 
 if TYPE_CHECKING:
+    import hnswlib
     from promptflow.src.flowchart import Flowchart
 
 
+def fields_file(filename: str) -> str:
+    """
+    Where the label columns of the index saved in filename are kept
+    """
+    return filename + ".fields.json"
+
+
+def read_fields(filename: str) -> Optional[list[str]]:
+    """
+    The label columns saved with an index, if any
+    """
+    if not os.path.exists(fields_file(filename)):
+        return None
+    with open(fields_file(filename), encoding="utf-8") as f:
+        return json.load(f)["fields"]
+
+
+def write_fields(filename: str, fields: list[str]):
+    with open(fields_file(filename) + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"fields": fields}, f)
+    os.replace(fields_file(filename) + ".tmp", fields_file(filename))
+
+
+class IndexParams:
+    """
+    Settings of an hnswlib index: the vector size and distance
+    ("l2", "cosine" or "ip"), how the graph is built (M, ef_construction),
+    and the capacity it starts with (max_elements, doubled as it fills)
+    """
+
+    __slots__ = ("space", "dim", "M", "ef_construction", "max_elements")
+
+    SPACES = ["l2", "cosine", "ip"]
+
+    def __init__(
+        self,
+        space: str = "l2",
+        dim: int = 768,
+        M: int = 16,  # pylint: disable=invalid-name
+        ef_construction: int = 200,
+        max_elements: int = 1024,
+    ):
+        if space not in self.SPACES:
+            raise ValueError(f"Unknown space {space!r}, expected one of {self.SPACES}")
+        self.space = space
+        self.dim = int(dim)
+        self.M = int(M)  # pylint: disable=invalid-name
+        self.ef_construction = int(ef_construction)
+        self.max_elements = int(max_elements)
+
+    @classmethod
+    def from_dict(cls, values: dict[str, Any]) -> "IndexParams":
+        return cls(**{key: values[key] for key in cls.__slots__ if key in values})
+
+    def serialize(self) -> dict[str, Any]:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, IndexParams) and self.serialize() == other.serialize()
+
+    def __repr__(self) -> str:
+        settings = ", ".join(f"{k}={v!r}" for k, v in self.serialize().items())
+        return f"IndexParams({settings})"
+
+
+class EmbeddingCollection:
+    """
+    An hnswlib index of documents, and the label file that maps its ids
+    back to them. Nothing is imported or created until it is first used.
+    """
+
+    def __init__(self, name: str, params: Optional[IndexParams] = None):
+        self.name = name
+        self.params = params or IndexParams()
+        self.index: Optional["hnswlib.Index"] = None
+        self.filename: Optional[str] = None
+        self.label_file: Optional[str] = None
+        # columns of the label file, in order
+        self.fields: list[str] = ["text"]
+        self.content_index: dict[int, dict[str, Any]] = {}
+        self._unsaved: list[int] = []
+        # where the next checkpoint appends labels; later rows are stale
+        self._labels_end = 0
+        self._ef: Optional[int] = None
+        self._conflict_warned = False
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def _new_index(self) -> "hnswlib.Index":
+        # imported here so flowcharts without embeddings don't load it
+        import hnswlib
+
+        self._ef = None
+        return hnswlib.Index(space=self.params.space, dim=self.params.dim)
+
+    def configure(self, params: IndexParams):
+        """
+        Use params for the index, unless it already has documents
+        """
+        with self._lock:
+            if params == self.params:
+                return
+            if self.index is not None and self.index.get_current_count():
+                # nodes sharing the collection ask on every run; say it once
+                if not self._conflict_warned:
+                    self._conflict_warned = True
+                    self.logger.warning(
+                        "Collection %s already holds documents, keeping %s",
+                        self.name,
+                        self.params,
+                    )
+                return
+            self.params = params
+            self.index = None
+
+    def encode(
+        self, texts: list[str], batch_size: int = 32, instruction: str = ""
+    ) -> np.ndarray:
+        """
+        Embed many texts at once, batch_size at a time. Texts embedded
+        before are taken from the embedding cache.
+        """
+        return get_embedder().encode(
+            texts, batch_size=batch_size, instruction=instruction
+        )
+
+    def load(self, filename: str, label_file: str, fields: Optional[list[str]] = None):
+        """
+        Load a saved index and its label file. fields are the label file's
+        columns, by default those saved with the index. Labels past the
+        index's last checkpoint (e.g. after a crash) are ignored, and cut
+        from the file before the next checkpoint appends to it.
+        """
+        with self._lock:
+            if fields is None:
+                fields = read_fields(filename)
+            if fields is None:
+                raise ValueError(
+                    f"No label columns saved with {filename}; give them explicitly"
+                )
+            self.index = self._new_index()
+            self.index.load_index(filename)
+            count = self.index.get_current_count()
+            self.filename = filename
+            self.label_file = label_file
+            self.fields = fields
+            self.content_index = {}
+            self._unsaved = []
+            consumed = end = 0
+
+            def lines(f) -> Iterator[str]:
+                nonlocal consumed
+                for line in f:
+                    consumed += len(line.encode("utf-8"))
+                    yield line
+
+            with open(label_file, "r", newline="", encoding="utf-8") as f:
+                for row in csv.reader(lines(f)):
+                    if len(self.content_index) >= count:
+                        break
+                    end = consumed
+                    if not row:
+                        continue
+                    self.content_index[len(self.content_index)] = {
+                        field: value for field, value in zip(fields, row) if value
+                    }
+            self._labels_end = end
+            if os.path.getsize(label_file) > end:
+                self.logger.warning(
+                    "%s has labels past the %d documents in %s; ignoring them",
+                    label_file,
+                    count,
+                    filename,
+                )
+
+    def start(self, filename: str, label_file: str, fields: list[str]):
+        """
+        Start a new, empty index saved to filename, with labels in label_file
+        """
+        with self._lock:
+            self.index = None
+            self.filename = filename
+            self.label_file = label_file
+            self.fields = fields
+            self.content_index = {}
+            self._unsaved = []
+            with open(label_file, "w", encoding="utf-8"):
+                pass
+            self._labels_end = 0
+            write_fields(filename, fields)
+
+    def _reserve(self, count: int):
+        """
+        Make room for count more items, doubling the index as it fills
+        """
+        if self.index is None:
+            self.index = self._new_index()
+            self.index.init_index(
+                max_elements=max(count, self.params.max_elements),
+                M=self.params.M,
+                ef_construction=self.params.ef_construction,
+            )
+            return
+        needed = self.index.get_current_count() + count
+        capacity = self.index.get_max_elements()
+        if needed > capacity:
+            self.logger.info(
+                "Growing collection %s to %d", self.name, max(needed, capacity * 2)
+            )
+            self.index.resize_index(max(needed, capacity * 2))
+
+    def add(
+        self,
+        documents: list[dict[str, Any]],
+        vectors: np.ndarray,
+        num_threads: int = -1,
+    ) -> list[int]:
+        """
+        Add documents and their embeddings, returning their ids.
+        Nothing is written to disk until the next checkpoint.
+        """
+        if vectors.shape[1] != self.params.dim:
+            raise ValueError(
+                f"Embeddings of size {vectors.shape[1]} don't fit collection "
+                f"{self.name} of size {self.params.dim}"
+            )
+        with self._lock:
+            self._reserve(len(documents))
+            assert self.index is not None
+            start = len(self.content_index)
+            ids = list(range(start, start + len(documents)))
+            self.index.add_items(vectors, ids, num_threads=num_threads)
+            for new_id, document in zip(ids, documents):
+                self.content_index[new_id] = document
+            self._unsaved.extend(ids)
+        return ids
+
+    def knn(
+        self,
+        vectors: np.ndarray,
+        k: int,
+        ef: int = 50,
+        num_threads: int = -1,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Ids and distances of the k nearest documents to each vector.
+        ef candidates are considered per query (at least k): higher finds
+        the true nearest documents more often, lower answers faster.
+        """
+        with self._lock:
+            count = 0 if self.index is None else self.index.get_current_count()
+            if not count:
+                return np.empty((len(vectors), 0), np.uint64), np.empty(
+                    (len(vectors), 0), np.float32
+                )
+            assert self.index is not None
+            k = min(k, count)
+            ef = max(ef, k)
+            if ef != self._ef:
+                self.index.set_ef(ef)
+                self._ef = ef
+            return self.index.knn_query(vectors, k=k, num_threads=num_threads)
+
+    def search(
+        self,
+        texts: list[str],
+        k: int,
+        ef: int = 50,
+        num_threads: int = -1,
+        batch_size: int = 32,
+        instruction: str = "",
+    ) -> list[list[dict[str, Any]]]:
+        """
+        The k nearest documents to each text, nearest first, as
+        {"id", "document", "distance"}. The texts are embedded together
+        and searched in one knn_query spread over num_threads.
+        """
+        if not texts:
+            return []
+        vectors = self.encode(texts, batch_size=batch_size, instruction=instruction)
+        ids, distances = self.knn(vectors, k, ef=ef, num_threads=num_threads)
+        return [
+            [
+                {
+                    "id": int(doc_id),
+                    "document": self.content_index[int(doc_id)],
+                    "distance": float(distance),
+                }
+                for doc_id, distance in zip(row_ids, row_distances)
+            ]
+            for row_ids, row_distances in zip(ids, distances)
+        ]
+
+    def checkpoint(self):
+        """
+        Append the labels added since the last checkpoint, then replace the
+        saved index. A crash in between leaves extra labels, which load cuts.
+        """
+        with self._lock:
+            if not self.filename or not self.label_file or self.index is None:
+                return
+            if not self._unsaved:
+                return
+            if os.path.getsize(self.label_file) > self._labels_end:
+                # labels of documents the saved index never got
+                self.logger.warning(
+                    "Dropping labels past the last checkpoint of %s", self.filename
+                )
+                with open(self.label_file, "r+b") as f:
+                    f.truncate(self._labels_end)
+            with open(self.label_file, "a", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerows(
+                    [self.content_index[i].get(field, "") for field in self.fields]
+                    for i in self._unsaved
+                )
+                f.flush()
+                os.fsync(f.fileno())
+            self._labels_end = os.path.getsize(self.label_file)
+            write_fields(self.filename, self.fields)
+            # never leave a half written index in place of the last good one
+            self.index.save_index(self.filename + ".tmp")
+            os.replace(self.filename + ".tmp", self.filename)
+            self._unsaved = []
+
+
 class EmbeddingsDatabaseSingleton:
     """
-    Holds the collection of embeddings in single instance, like a database
+    Holds the named collections of embeddings in single instance, like a database
     """
 
     _instance: Optional["EmbeddingsDatabaseSingleton"] = None
-    index: hnswlib.Index
-    index_file: Optional[str]
-    filename: str
-    content_index: dict
-    label_file: Optional[str]
-    instructor_model: INSTRUCTOR
+    collections: dict[str, EmbeddingCollection]
+
+    DEFAULT_COLLECTION = "default"
 
     def __new__(cls) -> "EmbeddingsDatabaseSingleton":
-        cls.logger = logging.getLogger(__name__)
         if cls._instance is None:
             cls._instance = super().__new__(cls)
-            # try and load existing collection
-            cls._instance.index = hnswlib.Index(space="l2", dim=768)
-            cls._instance.index_file = None
-            cls._instance.content_index = {}
-            cls._instance.label_file = None
-            cls._instance.instructor_model = INSTRUCTOR("hkunlp/instructor-large")
+            cls._instance.collections = {}
+            cls._instance._lock = threading.Lock()
         return cls._instance
 
+    def collection(
+        self, name: str = DEFAULT_COLLECTION, params: Optional[IndexParams] = None
+    ) -> EmbeddingCollection:
+        """
+        The named collection, created on first use. params apply to a new
+        or still empty collection.
+        """
+        with self._lock:
+            collection = self.collections.get(name)
+            if collection is None:
+                collection = self.collections[name] = EmbeddingCollection(name, params)
+                return collection
+        if params is not None:
+            collection.configure(params)
+        return collection
+
 
 class EmbeddingNode(NodeBase, ABC):
     """
@@ -57,6 +392,8 @@ class EmbeddingNode(NodeBase, ABC):
     """
 
     node_color = monokai.GREEN
+    # settings for the collection, if this node creates it
+    index_params: Optional[IndexParams] = None
 
     def __init__(
         self,
@@ -73,7 +410,18 @@ class EmbeddingNode(NodeBase, ABC):
             label,
             **kwargs,
         )
-        self.collection: EmbeddingsDatabaseSingleton = EmbeddingsDatabaseSingleton()
+        self.collection_name: str = kwargs.get(
+            "collection", EmbeddingsDatabaseSingleton.DEFAULT_COLLECTION
+        )
+
+    @property
+    def collection(self) -> EmbeddingCollection:
+        """
+        The collection this node reads or writes, by name
+        """
+        return EmbeddingsDatabaseSingleton().collection(
+            self.collection_name, self.index_params
+        )
 
     def oai_embeddings(self, string: str) -> List[float]:
         """
@@ -93,7 +441,7 @@ class EmbeddingNode(NodeBase, ABC):
         """
         Get the instructOR embeddings for a string
         """
-        return self.collection.instructor_model.encode(string)
+        return self.collection.encode([string])[0]
 
     def embeddings(self, string: str) -> List[float]:
         """
@@ -101,27 +449,80 @@ class EmbeddingNode(NodeBase, ABC):
         """
         return self.instructor_embeddings(string)
 
+    def serialize(self):
+        return super().serialize() | {"collection": self.collection_name}
+
 
 class EmbeddingInNode(EmbeddingNode):
     """
     Takes data from a node and puts it into an hnswlib index
     """
 
+    def __init__(
+        self,
+        flowchart: "Flowchart",
+        center_x: float,
+        center_y: float,
+        label: str,
+        **kwargs,
+    ):
+        super().__init__(
+            flowchart,
+            center_x,
+            center_y,
+            label,
+            **kwargs,
+        )
+        # save every this many additions; whatever is left is saved when the run ends
+        self.checkpoint_every: int = kwargs.get("checkpoint_every", 1)
+        self.index_params = IndexParams.from_dict(kwargs)
+        self.options_popup = None
+        self._added = 0
+        self._added_lock = threading.Lock()
+
     def run_subclass(
         self, before_result: Any, state, console: tkinter.scrolledtext.ScrolledText
     ) -> str:
-        new_id = len(self.collection.content_index)
-        self.collection.content_index[new_id] = state.result
-        self.collection.index.add_items(
-            np.array(self.embeddings(state.result)).reshape(1, -1), [new_id]
+        field = self.collection.fields[0]
+        self.collection.add(
+            [{field: state.result}],
+            np.array(self.embeddings(state.result), dtype=np.float32).reshape(1, -1),
         )
+        with self._added_lock:
+            self._added += 1
+            checkpoint = self._added % self.checkpoint_every == 0
+        if checkpoint:
+            self.collection.checkpoint()
+        return state.result
 
-        # Save index and mapping to files
-        self.collection.index.save_index(self.collection.filename)
-        with open(self.collection.label_file, "w") as f:
-            csv.writer(f).writerows(self.collection.content_index.items())
+    def finish_run(self):
+        self.collection.checkpoint()
 
-        return state.result
+    def edit_options(self, event):
+        self.options_popup = NodeOptions(
+            self.canvas,
+            {
+                "collection": self.collection_name,
+                "checkpoint_every": self.checkpoint_every,
+            }
+            | self.index_params.serialize(),
+            {"space": IndexParams.SPACES},
+        )
+        self.canvas.wait_window(self.options_popup)
+        result = self.options_popup.result
+        # check if cancel
+        if self.options_popup.cancelled:
+            return
+        self.collection_name = result["collection"]
+        self.checkpoint_every = max(int(result["checkpoint_every"]), 1)
+        self.index_params = IndexParams.from_dict(result)
+
+    def serialize(self):
+        return (
+            super().serialize()
+            | {"checkpoint_every": self.checkpoint_every}
+            | self.index_params.serialize()
+        )
 
 
 class EmbeddingQueryNode(EmbeddingNode):
@@ -150,37 +551,28 @@ class EmbeddingQueryNode(EmbeddingNode):
         )
         self.n_results = kwargs.get("n_results", 1)
         self.result_separator = kwargs.get("result_separator", "\n")
+        # candidates considered per query: higher is more accurate but slower
+        self.ef: int = kwargs.get("ef", 50)
+        # if set, the result is split on this into queries searched together
+        self.query_separator: str = kwargs.get("query_separator", "")
 
-    def query(self, query_embeddings: list[float], n_results):
+    def query(self, queries: list[str], n_results: int) -> list[list[dict[str, Any]]]:
         """
-        Query the embeddings using hnswlib
+        Query the embeddings using hnswlib, all queries at once
         """
-        st = time.process_time()
-        query_embeddings = np.array(query_embeddings)
-        indices, distances = self.collection.index.knn_query(
-            query_embeddings.reshape(1, -1), k=n_results
-        )
-
-        output = []
-        for index in indices[0]:
-            output.append(
-                {"document": self.collection.content_index[index], "id": index}
-            )
+        return self.collection.search(queries, n_results, ef=self.ef)
 
-        print("query time", time.process_time() - st)
-        return output
+    def _queries(self, result: Any) -> list[str]:
+        if isinstance(result, list):
+            return [str(query) for query in result]
+        if self.query_separator:
+            return [query for query in result.split(self.query_separator) if query]
+        return [result]
 
-    def run_subclass(
-        self, before_result: Any, state, console: tkinter.scrolledtext.ScrolledText
-    ) -> str:
-        results = self.query(
-            query_embeddings=self.embeddings(state.result),
-            n_results=self.n_results,
-        )
-        if len(results) == 0:
-            return ""
-        # return results["documents"][0][0]  # type: ignore
-        # return self.result_separator.join(map(lambda x: x["document"], results))  # type: ignore
+    def format_results(self, results: list[dict[str, Any]]) -> str:
+        """
+        One query's documents as "field: value" entries
+        """
         return_string = ""
         for result in results:
             doc = result["document"]
@@ -188,12 +580,27 @@ class EmbeddingQueryNode(EmbeddingNode):
                 return_string += f"{k}: {v}" + self.result_separator
         return return_string
 
+    def run_subclass(
+        self, before_result: Any, state, console: tkinter.scrolledtext.ScrolledText
+    ) -> Any:
+        results = [
+            self.format_results(found)
+            for found in self.query(self._queries(state.result), self.n_results)
+        ]
+        if isinstance(state.result, Choices):
+            # e.g. an LLM's choices: keep one result per choice
+            return Choices(results, branch=state.result.branch)
+        return "".join(results)
+
     def edit_options(self, event):
         self.options_popup = NodeOptions(
             self.canvas,
             {
+                "collection": self.collection_name,
                 "n_results": self.n_results,
                 "result_separator": self.result_separator,
+                "ef": self.ef,
+                "query_separator": self.query_separator,
             },
         )
         self.canvas.wait_window(self.options_popup)
@@ -201,13 +608,18 @@ class EmbeddingQueryNode(EmbeddingNode):
         # check if cancel
         if self.options_popup.cancelled:
             return
+        self.collection_name = result["collection"]
         self.n_results = int(result["n_results"])
         self.result_separator = result["result_separator"]
+        self.ef = int(result["ef"])
+        self.query_separator = result["query_separator"]
 
     def serialize(self):
         return super().serialize() | {
             "n_results": self.n_results,
             "result_separator": self.result_separator,
+            "ef": self.ef,
+            "query_separator": self.query_separator,
         }
 
 
@@ -236,25 +648,22 @@ class EmbeddingsIngestNode(EmbeddingNode):
         self.label_file = kwargs.get("label_file", "")
         self.options_popup = None
         self.rows = kwargs.get("rows", [])
+        # M, ef_construction and max_elements are read from the index file
+        self.index_params = IndexParams.from_dict(kwargs)
 
     def run_subclass(
         self, before_result: Any, state, console: tkinter.scrolledtext.ScrolledText
     ) -> str:
-        self.collection.index.load_index(self.filename)
-        with open(self.label_file, "r") as f:
-            csv_reader = csv.DictReader(f, fieldnames=self.rows)
-            self.collection.content_index = {}
-            for i, row in enumerate(csv_reader):
-                self.collection.content_index[i] = {
-                    row_name: row for row_name in self.rows if row_name in row.keys()
-                }
+        collection = self.collection
+        fields = self.rows or read_fields(self.filename) or collection.fields
+        collection.load(self.filename, self.label_file, fields)
         return state.result
 
     def edit_options(self, event):
         self.options_popup = MultiFileInput(
             self.canvas,
             {
-                "Rows": self.rows,
+                "Rows": ",".join(self.rows),
                 "Bin File (.bin)": self.filename,
                 "CSV File (.csv)": self.label_file,
             },
@@ -264,10 +673,25 @@ class EmbeddingsIngestNode(EmbeddingNode):
         # check if cancel
         if self.options_popup.cancelled:
             return
-        self.rows = result["Rows"].split(",")
+        self.rows = result["Rows"].split(",") if result["Rows"] else []
         self.filename = result["Bin File (.bin)"]
         self.label_file = result["CSV File (.csv)"]
 
+        self.options_popup = NodeOptions(
+            self.canvas,
+            {
+                "collection": self.collection_name,
+                "space": self.index_params.space,
+                "dim": self.index_params.dim,
+            },
+            {"space": IndexParams.SPACES},
+        )
+        self.canvas.wait_window(self.options_popup)
+        if not self.options_popup.cancelled:
+            result = self.options_popup.result
+            self.collection_name = result["collection"]
+            self.index_params = IndexParams.from_dict(result)
+
         self.collection.label_file = self.label_file
         self.collection.filename = self.filename
 
@@ -276,7 +700,12 @@ class EmbeddingsIngestNode(EmbeddingNode):
         # start path is directory of execution
         self.filename = os.path.relpath(self.filename, ".")
         self.label_file = os.path.relpath(self.label_file, ".")
-        return super().serialize() | {
-            "filename": self.filename,
-            "label_file": self.label_file,
-        }
+        return (
+            super().serialize()
+            | {
+                "filename": self.filename,
+                "label_file": self.label_file,
+                "rows": self.rows,
+            }
+            | self.index_params.serialize()
+        )
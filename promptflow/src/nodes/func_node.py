@@ -47,10 +47,14 @@ class FuncNode(NodeBase, ABC):
             self.func.text = DEFAULT_FUNC_TEMPLATE
         # convert function to string
         self.functext = self.func.label
+        self.text_window: Optional[CodeInput] = None
+
+    def draw_view(self):
+        super().draw_view()
         self.func_item = self.canvas.create_text(
-            center_x,
-            center_y + 30,
-            text=self.functext,
+            self.center_x,
+            self.center_y + 30,
+            text=self.func.label,
             fill="black",
             width=self.size_px * 2,
             justify="center",
@@ -59,7 +63,6 @@ class FuncNode(NodeBase, ABC):
         self.canvas.tag_bind(self.func_item, "<Double-Button-1>", self.edit_options)
         self.bind_drag()
         self.bind_mouseover()
-        self.text_window: Optional[CodeInput] = None
 
     def run_subclass(
         self, before_result: Any, state, console: tk.scrolledtext.ScrolledText
@@ -67,18 +70,15 @@ class FuncNode(NodeBase, ABC):
         """
         Evaluate the Python function and return the result.
         """
-        loc = state.copy() | {"result": None}
         try:
-            exec(self.func.text, dict(globals()), loc.snapshot)
+            namespace = self.func.namespace()
         except Exception as node_exception:
             raise RuntimeError(
                 f"Error in function: {node_exception}"
             ) from node_exception
-        if "main" not in loc.snapshot:
+        if "main" not in namespace:
             raise NameError("Function must have a main() function")
-        # todo make this less hacky
-        result = loc.snapshot["main"](state)  # type: ignore
-        return result
+        return namespace["main"](state)
 
     def serialize(self):
         return super().serialize() | {
@@ -46,11 +46,15 @@ class HistoryNode(NodeBase):
             label,
             **kwargs,
         )
-        self.role_var = tk.StringVar(value=kwargs.get("role", Role.USER.value))
+        self.role: str = kwargs.get("role", Role.USER.value)
+        self.options_popup: Optional[NodeOptions] = None
+
+    def draw_view(self):
+        super().draw_view()
         self.role_item = self.canvas.create_text(
-            center_x,
-            center_y + 30,
-            text=self.role_var.get(),
+            self.center_x,
+            self.center_y + 30,
+            text=self.role,
             font=("Arial", 10),
             fill="black",
             width=self.size_px * 2,
@@ -60,7 +64,6 @@ class HistoryNode(NodeBase):
         self.bind_drag()
         self.bind_mouseover()
         self.canvas.tag_bind(self.role_item, "<Double-Button-1>", self.edit_options)
-        self.options_popup: Optional[NodeOptions] = None
 
     def run_subclass(
         self, before_result: Any, state, console: tk.scrolledtext.ScrolledText
@@ -68,14 +71,19 @@ class HistoryNode(NodeBase):
         """
         Injects date into state
         """
-        state.history.append({"role": self.role_var.get(), "content": state.result})
+        state.history.append({"role": self.role, "content": state.result})
         return state.result
 
+    def cost(self, state: State) -> float:
+        # later LLM nodes send this history, so add to it as a run would
+        state.history.append({"role": self.role, "content": str(state.result)})
+        return super().cost(state)
+
     def edit_options(self, event):
         self.options_popup = NodeOptions(
             self.canvas,
             {
-                "role": self.role_var.get(),
+                "role": self.role,
             },
             {
                 "role": [Role.USER.value, Role.SYSTEM.value, Role.ASSISTANT.value],
@@ -86,10 +94,10 @@ class HistoryNode(NodeBase):
         # check if cancel
         if self.options_popup.cancelled:
             return
-        self.role_var.set(result["role"])
-        self.canvas.itemconfig(self.role_item, text=self.role_var.get())
+        self.role = result["role"]
+        self.canvas.itemconfig(self.role_item, text=self.role)
 
     def serialize(self):
         return super().serialize() | {
-            "role": self.role_var.get(),
+            "role": self.role,
         }
@@ -5,6 +5,7 @@ from enum import Enum
 import tkinter
 from typing import Any, Callable
 import json
+import aiohttp
 import requests
 from promptflow.src.dialogues.node_options import NodeOptions
 
@@ -52,6 +53,9 @@ class HttpNode(NodeBase):
         self.url = kwargs.get("url", "")
         self.request_type = kwargs.get("request_type", RequestType.GET.value)
         self.options_popup: NodeOptions = None
+
+    def draw_view(self):
+        super().draw_view()
         self.request_type_item = self.canvas.create_text(
             self.center_x,
             self.center_y + 30,
@@ -81,6 +85,22 @@ class HttpNode(NodeBase):
         response = request_functions[self.request_type](self.url, json=data)
         return response.text
 
+    async def arun_subclass(
+        self, before_result: Any, state, console: tkinter.scrolledtext.ScrolledText
+    ) -> str:
+        """
+        Sends a http request without blocking the event loop
+        """
+        try:
+            data = json.loads(state.result)
+        except json.decoder.JSONDecodeError:
+            return "Invalid JSON"
+        async with aiohttp.ClientSession() as session:
+            async with session.request(
+                self.request_type, self.url, json=data
+            ) as response:
+                return await response.text()
+
     def edit_options(self, event):
         self.options_popup = NodeOptions(
             self.canvas,
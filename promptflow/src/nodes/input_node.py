@@ -13,6 +13,9 @@ class InputNode(NodeBase):
     """
 
     def before(self, state, console):
+        if self.canvas is None:
+            # headless runs read queued input from the console instead
+            return {"input": console.get_input(self.label) if console else None}
         dialog = customtkinter.CTkInputDialog(
             text="Enter a value for this input:", title=self.label
         )
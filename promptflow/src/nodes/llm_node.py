@@ -1,10 +1,26 @@
-from typing import TYPE_CHECKING, Any, Optional
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, Iterator, Optional
 
-import tiktoken
-from promptflow.src.state import State
+from collections import Counter
+from contextlib import contextmanager
+
+from promptflow.src.state import Choices, State
 
 from promptflow.src.text_data import TextData
-from promptflow.src.utils import retry_with_exponential_backoff
+from promptflow.src.tracing import annotate
+from promptflow.src import streaming
+from promptflow.src.llm_batching import get_batcher
+from promptflow.src.rate_limit import alimited, get_rate_limiter, limited
+from promptflow.src import usage
+from promptflow.src.llm_cache import (
+    CompletionCache,
+    acached_create,
+    cached_create,
+    get_cache,
+)
+from promptflow.src.utils import (
+    retry_with_exponential_backoff,
+    aretry_with_exponential_backoff,
+)
 
 if TYPE_CHECKING:
     from promptflow.src.flowchart import Flowchart
@@ -37,23 +53,112 @@ chat_models = [
 ]
 
 
-# https://openai.com/pricing
-prompt_cost_1k = {
-    Model.textdavinci.value: 0.02,
-    Model.gpt35turbo.value: 0.002,
-    Model.gpt35turbo0301.value: 0.002,
-    Model.gpt4.value: 0.03,
-    Model.gpt40314.value: 0.03,
-}
-completion_cost_1k = {
-    Model.textdavinci.value: 0.02,
-    Model.gpt35turbo.value: 0.002,
-    Model.gpt35turbo0301.value: 0.002,
-    Model.gpt4.value: 0.06,
-    Model.gpt40314.value: 0.06,
+def _chunk_text(choice: dict[str, Any], chat: bool) -> str:
+    if chat:
+        return choice.get("delta", {}).get("content") or ""
+    return choice.get("text") or ""
+
+
+def _chunk_texts(
+    chunks: Iterator[dict[str, Any]], chat: bool
+) -> Iterator[tuple[int, str]]:
+    """
+    (choice index, text) for each piece of each choice
+    """
+    for chunk in chunks:
+        for choice in chunk["choices"]:
+            text = _chunk_text(choice, chat)
+            if text:
+                yield choice.get("index", 0), text
+
+
+async def _achunk_texts(
+    chunks: AsyncIterator[dict[str, Any]], chat: bool
+) -> AsyncIterator[tuple[int, str]]:
+    async for chunk in chunks:
+        for choice in chunk["choices"]:
+            text = _chunk_text(choice, chat)
+            if text:
+                yield choice.get("index", 0), text
+
+
+def _completion_response(parts: dict[int, list[str]], chat: bool) -> dict[str, Any]:
+    """
+    A response in the shape of a non-streamed one, for the streamed
+    pieces of each choice
+    """
+    texts = [
+        "".join(parts.get(index, [])) for index in range(max(parts, default=0) + 1)
+    ]
+    if chat:
+        return {
+            "choices": [
+                {"index": index, "message": {"role": "assistant", "content": text}}
+                for index, text in enumerate(texts)
+            ]
+        }
+    return {
+        "choices": [{"index": index, "text": text} for index, text in enumerate(texts)]
+    }
+
+
+def _response_text(completion: dict[str, Any], chat: bool) -> str:
+    if chat:
+        return completion["choices"][0]["message"]["content"]
+    return completion["choices"][0]["text"]
+
+
+def _choice_texts(completion: dict[str, Any], chat: bool) -> list[str]:
+    if chat:
+        return [choice["message"]["content"] for choice in completion["choices"]]
+    return [choice["text"] for choice in completion["choices"]]
+
+
+class _Emitted:
+    """
+    The text a node has streamed so far, kept across the retries of a request
+    so the sinks don't receive it twice
+    """
+
+    def __init__(self):
+        self.length = 0
+
+    def emit(self, node: NodeBase, text: str):
+        """
+        Stream whatever the attempt's text so far adds to what was already sent
+        """
+        if len(text) > self.length:
+            streaming.emit(node, text[self.length :])
+            self.length = len(text)
+
+
+def _vote(choices: list[str]) -> str:
+    """
+    The most common choice, ignoring case and surrounding whitespace;
+    ties go to the earliest
+    """
+    counts = Counter(choice.strip().casefold() for choice in choices)
+    winner = max(counts, key=counts.__getitem__)
+    return next(choice for choice in choices if choice.strip().casefold() == winner)
+
+
+# ways to turn an LLM node's n choices into its output
+selectors: dict[str, Callable[[list[str]], Any]] = {
+    "first": lambda choices: choices[0],
+    "all": Choices,
+    "branches": lambda choices: Choices(choices, branch=True),
+    "vote": _vote,
 }
 
 
+def register_selector(name: str, selector: Callable[[list[str]], Any]):
+    """
+    Make a selection step available to LLM nodes, e.g. a judge that picks
+    the best of the choices
+    """
+    selectors[name] = selector
+
+
 class LLMNode(NodeBase):
     """
     Node that uses the OpenAI API to generate text.
@@ -78,13 +183,11 @@ class LLMNode(NodeBase):
         self.presence_penalty = 0.0
         self.frequency_penalty = 0.0
 
-        self.model_var = tk.StringVar(value=model)
         self.model = model
+        self.use_cache: bool = kwargs.get("use_cache", True)
+        self.stream: bool = kwargs.get("stream", False)
+        self.select: str = kwargs.get("select", "first")
         super().__init__(flowchart, center_x, center_y, label, **kwargs)
-        self.canvas.tag_bind(self.item, "<Double-Button-1>", self.edit_options)
-        self.canvas.update()
-        self.bind_drag()
-        self.bind_mouseover()
         self.text_window: Optional[TextInput] = None
         self.options_popup: Optional[NodeOptions] = None
 
@@ -95,7 +198,7 @@ class LLMNode(NodeBase):
         self.options_popup = NodeOptions(
             self.canvas,
             {
-                "Model": self.model_var.get(),
+                "Model": self.model,
                 "Temperature": self.temperature,
                 "Top P": self.top_p,
                 "n": self.n,
@@ -103,9 +206,15 @@ class LLMNode(NodeBase):
                 "Max Tokens": self.max_tokens,
                 "presence_penalty": self.presence_penalty,
                 "frequency_penalty": self.frequency_penalty,
+                "Cache": str(self.use_cache),
+                "Stream": str(self.stream),
+                "Select": self.select,
             },
             {
                 "Model": [model.value for model in Model],
+                "Cache": ["True", "False"],
+                "Stream": ["True", "False"],
+                "Select": list(selectors),
             },
         )
         self.canvas.wait_window(self.options_popup)
@@ -113,7 +222,7 @@ class LLMNode(NodeBase):
         # check if cancel
         if self.options_popup.cancelled:
             return
-        self.model_var.set(result["Model"])
+        self.model = result["Model"]
         self.on_model_select(None)  # todo: manually calling this is a bit hacky
         self.max_tokens = int(result["Max Tokens"])
         self.temperature = float(result["Temperature"])
@@ -122,57 +231,209 @@ class LLMNode(NodeBase):
         # self.stop = result["stop"]
         self.presence_penalty = float(result["presence_penalty"])
         self.frequency_penalty = float(result["frequency_penalty"])
+        self.use_cache = result["Cache"] == "True"
+        self.stream = result["Stream"] == "True"
+        self.select = result["Select"]
 
-    @retry_with_exponential_backoff
-    def _chat_completion(self, prompt: str, state: State) -> str:
+    @property
+    def cache(self) -> Optional[CompletionCache]:
         """
-        Simple wrapper around the OpenAI API to generate text.
+        The completion cache this node reads and writes, if caching is on
+        both globally and for this node
+        """
+        return get_cache() if self.use_cache else None
+
+    def _chat_request(self, prompt: str, state: State) -> dict[str, Any]:
+        """
+        Arguments for an OpenAI chat completion request
         """
         messages = [
             *state.history,
         ]
         if prompt:
             messages.append({"role": "user", "content": prompt})
-        completion = openai.ChatCompletion.create(
-            model=self.model_var.get(),
-            messages=messages,
-            temperature=self.temperature,
-            top_p=self.top_p,
-            n=self.n,
-            # stop=self.stop,
-            max_tokens=self.max_tokens,
-            presence_penalty=self.presence_penalty,
-            frequency_penalty=self.frequency_penalty,
+        return {
+            "model": self.model,
+            "messages": messages,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "n": self.n,
+            # "stop": self.stop,
+            "max_tokens": self.max_tokens,
+            "presence_penalty": self.presence_penalty,
+            "frequency_penalty": self.frequency_penalty,
+        }
+
+    def _completion_request(self, prompt: str, state: State) -> dict[str, Any]:
+        """
+        Arguments for an OpenAI completion request
+        """
+        # todo this history is really opinionated
+        history = state.history.transcript()
+        prompt = f"{history}\n{prompt}\n"
+        return {
+            "model": self.model,
+            "prompt": prompt,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "n": self.n,
+            # "stop": self.stop,
+            "presence_penalty": self.presence_penalty,
+            "frequency_penalty": self.frequency_penalty,
+        }
+
+    def _create(
+        self,
+        create: Callable[..., Any],
+        request: dict[str, Any],
+        chat: bool,
+        emitted: _Emitted,
+    ) -> dict[str, Any]:
+        """
+        Send the request through the cache, streaming the output to the
+        current output sinks if this node streams. Legacy completions
+        go through the process's batcher, if there is one, which applies
+        the rate limit per batch; other requests are rate limited here.
+        """
+        batcher = get_batcher()
+        if batcher is not None and not chat and not self.stream:
+            return cached_create(batcher.submit, request, self.cache)
+        create = limited(create, get_rate_limiter())
+        if not self.stream:
+            return cached_create(create, request, self.cache)
+
+        def stream_create(**kwargs) -> dict[str, Any]:
+            parts: dict[int, list[str]] = {}
+            text = ""
+            for index, chunk in _chunk_texts(create(stream=True, **kwargs), chat):
+                parts.setdefault(index, []).append(chunk)
+                # with n > 1, only the first choice is shown as it arrives
+                if index == 0:
+                    text += chunk
+                    emitted.emit(self, text)
+            return _completion_response(parts, chat)
+
+        completion = cached_create(stream_create, request, self.cache)
+        # answered from the cache, pass on whatever hasn't been streamed
+        emitted.emit(self, _response_text(completion, chat))
+        return completion
+
+    async def _acreate(
+        self,
+        acreate: Callable[..., Any],
+        request: dict[str, Any],
+        chat: bool,
+        emitted: _Emitted,
+    ) -> dict[str, Any]:
+        """
+        Async version of _create
+        """
+        batcher = get_batcher()
+        if batcher is not None and not chat and not self.stream:
+            return await acached_create(batcher.asubmit, request, self.cache)
+        acreate = alimited(acreate, get_rate_limiter())
+        if not self.stream:
+            return await acached_create(acreate, request, self.cache)
+
+        async def stream_create(**kwargs) -> dict[str, Any]:
+            parts: dict[int, list[str]] = {}
+            text = ""
+            chunks = await acreate(stream=True, **kwargs)
+            async for index, chunk in _achunk_texts(chunks, chat):
+                parts.setdefault(index, []).append(chunk)
+                if index == 0:
+                    text += chunk
+                    emitted.emit(self, text)
+            return _completion_response(parts, chat)
+
+        completion = await acached_create(stream_create, request, self.cache)
+        emitted.emit(self, _response_text(completion, chat))
+        return completion
+
+    @contextmanager
+    def _streaming(self) -> Iterator[_Emitted]:
+        """
+        Track what is streamed over every attempt of a request, and close
+        the node's output once the request succeeds or gives up
+        """
+        try:
+            yield _Emitted()
+        finally:
+            if self.stream:
+                streaming.close(self)
+
+    def choose(self, choices: list[str]) -> Any:
+        """
+        The node's output from its choices, using the selected selection step
+        """
+        selector = selectors.get(self.select)
+        if selector is None:
+            raise ValueError(f"Unknown selection step '{self.select}'")
+        return selector(choices)
+
+    def _record_usage(
+        self, request: dict[str, Any], completion: dict[str, Any], chat: bool
+    ):
+        """
+        Attach the tokens the request used to the current span and usage ledger
+        """
+        annotate(model=self.model, **completion.get("usage", {}))
+        usage.record(
+            self,
+            self.model,
+            usage.response_usage(request, completion, _choice_texts(completion, chat)),
         )
-        return completion["choices"][0]["message"]["content"]  # type: ignore
 
     @retry_with_exponential_backoff
-    def _completion(self, prompt: str, state: State) -> str:
+    def _chat_completion(self, prompt: str, state: State, emitted: _Emitted) -> Any:
         """
         Simple wrapper around the OpenAI API to generate text.
         """
-        # todo this history is really opinionated
-        history = "\n".join(
-            [
-                *[
-                    f"{message['role']}: {message['content']}"
-                    for message in state.history
-                ],
-            ]
+        request = self._chat_request(prompt, state)
+        completion = self._create(
+            openai.ChatCompletion.create, request, chat=True, emitted=emitted
         )
-        prompt = f"{history}\n{prompt}\n"
-        completion = openai.Completion.create(
-            model=self.model_var.get(),
-            prompt=prompt,
-            max_tokens=self.max_tokens,
-            temperature=self.temperature,
-            top_p=self.top_p,
-            n=self.n,
-            # stop=self.stop,
-            presence_penalty=self.presence_penalty,
-            frequency_penalty=self.frequency_penalty,
+        self._record_usage(request, completion, chat=True)
+        return self.choose(_choice_texts(completion, chat=True))
+
+    @retry_with_exponential_backoff
+    def _completion(self, prompt: str, state: State, emitted: _Emitted) -> Any:
+        """
+        Simple wrapper around the OpenAI API to generate text.
+        """
+        request = self._completion_request(prompt, state)
+        completion = self._create(
+            openai.Completion.create, request, chat=False, emitted=emitted
+        )
+        self._record_usage(request, completion, chat=False)
+        return self.choose(_choice_texts(completion, chat=False))
+
+    @aretry_with_exponential_backoff
+    async def _achat_completion(
+        self, prompt: str, state: State, emitted: _Emitted
+    ) -> Any:
+        """
+        Async version of _chat_completion
+        """
+        request = self._chat_request(prompt, state)
+        completion = await self._acreate(
+            openai.ChatCompletion.acreate, request, chat=True, emitted=emitted
         )
-        return completion["choices"][0]["text"]  # type: ignore
+        self._record_usage(request, completion, chat=True)
+        return self.choose(_choice_texts(completion, chat=True))
+
+    @aretry_with_exponential_backoff
+    async def _acompletion(self, prompt: str, state: State, emitted: _Emitted) -> Any:
+        """
+        Async version of _completion
+        """
+        request = self._completion_request(prompt, state)
+        completion = await self._acreate(
+            openai.Completion.acreate, request, chat=False, emitted=emitted
+        )
+        self._record_usage(request, completion, chat=False)
+        return self.choose(_choice_texts(completion, chat=False))
 
     def run_subclass(
         self, before_result: Any, state, console: tk.scrolledtext.ScrolledText
@@ -183,36 +444,58 @@ class LLMNode(NodeBase):
         openai.api_key = os.getenv("OPENAI_API_KEY")
         prompt = state.result
         self.logger.info(f"Running LLMNode with prompt: {prompt}")
-        if self.model in chat_models:
-            completion = self._chat_completion(prompt, state)
-        else:
-            completion = self._completion(prompt, state)
+        with self._streaming() as emitted:
+            if self.model in chat_models:
+                completion = self._chat_completion(prompt, state, emitted)
+            else:
+                completion = self._completion(prompt, state, emitted)
+        self.logger.info(f"Result of LLMNode is {completion}")  # type: ignore
+        return completion  # type: ignore
+
+    async def arun_subclass(
+        self, before_result: Any, state, console: tk.scrolledtext.ScrolledText
+    ) -> str:
+        """
+        Format the prompt and await the OpenAI API.
+        """
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+        prompt = state.result
+        self.logger.info(f"Running LLMNode with prompt: {prompt}")
+        with self._streaming() as emitted:
+            if self.model in chat_models:
+                completion = await self._achat_completion(prompt, state, emitted)
+            else:
+                completion = await self._acompletion(prompt, state, emitted)
         self.logger.info(f"Result of LLMNode is {completion}")  # type: ignore
         return completion  # type: ignore
 
     def serialize(self):
         return super().serialize() | {
-            "model": self.model_var.get(),
+            "model": self.model,
+            "use_cache": self.use_cache,
+            "stream": self.stream,
+            "select": self.select,
         }
 
     def on_model_select(self, _: Optional[tk.Event]):
         """
         Callback for when the OpenAI model is changed.
         """
-        self.model = self.model_var.get()
         if self.model in [Model.gpt4.value, Model.gpt40314.value]:
             self.logger.warning("You're using a GPT-4 model. This is costly.")
         self.logger.info(f"Selected model: {self.model}")
 
     def cost(self, state: State) -> float:
         """
-        Return the cost of running this node.
+        Return the most running this node can cost: the request exactly as it
+        would be sent, history included, with every choice using max_tokens.
         """
-        # count the number of tokens
-        enc = tiktoken.encoding_for_model(self.model)
-        prompt_tokens = enc.encode(state.result.format(state=state))
-        max_completion_tokens = self.max_tokens - len(prompt_tokens)
-        prompt_cost = prompt_cost_1k[self.model] * len(prompt_tokens) / 1000
-        completion_cost = completion_cost_1k[self.model] * max_completion_tokens / 1000
-        total = prompt_cost + completion_cost
-        return total
+        prompt = str(state.result)
+        if self.model in chat_models:
+            request = self._chat_request(prompt, state)
+        else:
+            request = self._completion_request(prompt, state)
+        # what the model will say isn't known yet
+        state.result = ""
+        state.snapshot[self.label] = ""
+        return usage.estimate(request).cost
@@ -2,10 +2,24 @@
 Handles state history and memory nodes
 """
 from abc import ABC
+import contextvars
+import hashlib
+import json
+import threading
 import tkinter
-from typing import TYPE_CHECKING, Any
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Optional
+import openai
+from promptflow.src import usage
+from promptflow.src.history import History
+from promptflow.src.llm_cache import cached_create, get_cache
+from promptflow.src.nodes.llm_node import Model, chat_models
+from promptflow.src.rate_limit import get_rate_limiter, limited
+from promptflow.src.utils import retry_with_exponential_backoff
 from promptflow.src.nodes.node_base import NodeBase
 from promptflow.src.state import State
+from promptflow.src.text_data import compile_expression
 from promptflow.src.dialogues.node_options import NodeOptions
 from promptflow.src.themes import monokai
 
@@ -35,10 +49,9 @@ class MemoryNode(NodeBase, ABC):
             label,
             **kwargs,
         )
-        self.canvas.tag_bind(self.item, "<Double-Button-1>", self.edit_options)
         self.options_popup = None
 
-    def memory(self, state: State) -> list[dict[str, str]]:
+    def memory(self, state: State) -> History:
         """
         Update state history
         """
@@ -48,15 +61,7 @@ class MemoryNode(NodeBase, ABC):
     def run_subclass(
         self, before_result: Any, state, console: tkinter.scrolledtext.ScrolledText
     ) -> str:
-        history_string = "\n".join(
-            [
-                *[
-                    f"{message['role']}: {message['content']}"
-                    for message in self.memory(state)
-                ],
-            ]
-        )
-        return history_string
+        return self.memory(state).transcript()
 
 
 class WindowedMemoryNode(MemoryNode):
@@ -102,6 +107,215 @@ class WindowedMemoryNode(MemoryNode):
         return super().serialize() | {"window": self.window}
 
 
+class TokenWindowedMemoryNode(MemoryNode):
+    """
+    Like WindowedMemoryNode, but keeps the most recent messages that fit
+    in max_tokens for the given model
+    """
+
+    def __init__(
+        self,
+        flowchart: "Flowchart",
+        center_x: float,
+        center_y: float,
+        label: str,
+        max_tokens: int = 2000,
+        model: str = Model.gpt35turbo.value,
+        **kwargs,
+    ):
+        super().__init__(
+            flowchart,
+            center_x,
+            center_y,
+            label,
+            **kwargs,
+        )
+        self.max_tokens = max_tokens
+        self.model = model
+
+    def memory(self, state: State) -> History:
+        # token counts are cached on the history, so only new messages are counted
+        return state.history.trim(self.model, self.max_tokens)
+
+    def edit_options(self, event):
+        self.options_popup = NodeOptions(
+            self.canvas,
+            {"Max Tokens": self.max_tokens, "Model": self.model},
+            {"Model": [model.value for model in Model]},
+        )
+        self.canvas.wait_window(self.options_popup)
+        result = self.options_popup.result
+        # check if cancel
+        if self.options_popup.cancelled:
+            return
+        self.max_tokens = int(result["Max Tokens"])
+        self.model = result["Model"]
+
+    def serialize(self):
+        return super().serialize() | {
+            "max_tokens": self.max_tokens,
+            "model": self.model,
+        }
+
+
+class SummarizingMemoryNode(MemoryNode):
+    """
+    Keeps the most recent messages that fit in max_tokens, and folds older
+    ones into a summary at the start of the history. Summaries are written
+    by an LLM in the background: until one is ready, older messages stay in
+    the history, so a turn never waits and nothing is lost.
+    """
+
+    summary_prefix = "Summary of the conversation so far:\n"
+    instructions = (
+        "Update the summary of a conversation with its new messages. "
+        "Keep names, facts, decisions and open questions; be concise."
+    )
+    max_cached_summaries = 256
+
+    def __init__(
+        self,
+        flowchart: "Flowchart",
+        center_x: float,
+        center_y: float,
+        label: str,
+        max_tokens: int = 2000,
+        model: str = Model.gpt35turbo.value,
+        summary_tokens: int = 256,
+        **kwargs,
+    ):
+        super().__init__(
+            flowchart,
+            center_x,
+            center_y,
+            label,
+            **kwargs,
+        )
+        self.max_tokens = max_tokens
+        self.model = model
+        self.summary_tokens = summary_tokens
+        # summaries keyed by the summary and messages they replace;
+        # shared by every run of the flowchart, e.g. the records of a batch
+        self._summaries: OrderedDict[str, Future] = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    def is_summary(self, message: dict[str, str]) -> bool:
+        return message["role"] == "system" and message["content"].startswith(
+            self.summary_prefix
+        )
+
+    @staticmethod
+    def _chain(key: str, message: dict[str, str]) -> str:
+        return hashlib.sha256(
+            (key + json.dumps(message, sort_keys=True)).encode()
+        ).hexdigest()
+
+    def memory(self, state: State) -> History:
+        history = state.history
+        summarized = 1 if history and self.is_summary(history[0]) else 0
+        summary = history[0]["content"] if summarized else ""
+        start = max(history.window_start(self.model, self.max_tokens), summarized)
+        if start == summarized:
+            return history
+        # find the longest run of old messages a summary has been started for
+        keys = [self._chain(self.model, {"role": "system", "content": summary})]
+        for message in history[summarized:start]:
+            keys.append(self._chain(keys[-1], message))
+        with self._lock:
+            covered = next(
+                (i for i in range(len(keys) - 1, 0, -1) if keys[i] in self._summaries),
+                0,
+            )
+            future = self._summaries.get(keys[covered]) if covered else None
+            if future is None:
+                covered = len(keys) - 1
+                future = self._submit(keys[covered], summary, history[summarized:start])
+            else:
+                self._summaries.move_to_end(keys[covered])
+        if not future.done():
+            return history
+        if future.exception() is not None:
+            self.logger.warning(f"Summarizing history failed: {future.exception()}")
+            with self._lock:
+                self._summaries.pop(keys[covered], None)
+            return history
+        state.history = history[summarized + covered :]
+        state.history.insert(
+            0, {"role": "system", "content": self.summary_prefix + future.result()}
+        )
+        return state.history
+
+    def _submit(self, key: str, summary: str, messages: list[dict[str, str]]) -> Future:
+        """
+        Start summarizing in the background; call with the lock held
+        """
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="summarize"
+            )
+        # usage and rate limits apply as if called from the node's run
+        context = contextvars.copy_context()
+        future = self._pool.submit(context.run, self._summarize, summary, messages)
+        self._summaries[key] = future
+        if len(self._summaries) > self.max_cached_summaries:
+            self._summaries.popitem(last=False)
+        return future
+
+    @retry_with_exponential_backoff
+    def _summarize(self, summary: str, messages: list[dict[str, str]]) -> str:
+        """
+        The summary updated with messages
+        """
+        previous = summary[len(self.summary_prefix) :] or "(none)"
+        request = {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": self.instructions},
+                {
+                    "role": "user",
+                    "content": f"Summary:\n{previous}\n\n"
+                    f"New messages:\n{History(messages).transcript()}",
+                },
+            ],
+            "temperature": 0.0,
+            "max_tokens": self.summary_tokens,
+        }
+        create = limited(openai.ChatCompletion.create, get_rate_limiter())
+        completion = cached_create(create, request, get_cache())
+        text = completion["choices"][0]["message"]["content"].strip()
+        usage.record(
+            self, self.model, usage.response_usage(request, completion, [text])
+        )
+        return text
+
+    def edit_options(self, event):
+        self.options_popup = NodeOptions(
+            self.canvas,
+            {
+                "Max Tokens": self.max_tokens,
+                "Model": self.model,
+                "Summary Tokens": self.summary_tokens,
+            },
+            {"Model": chat_models},
+        )
+        self.canvas.wait_window(self.options_popup)
+        result = self.options_popup.result
+        # check if cancel
+        if self.options_popup.cancelled:
+            return
+        self.max_tokens = int(result["Max Tokens"])
+        self.model = result["Model"]
+        self.summary_tokens = int(result["Summary Tokens"])
+
+    def serialize(self):
+        return super().serialize() | {
+            "max_tokens": self.max_tokens,
+            "model": self.model,
+            "summary_tokens": self.summary_tokens,
+        }
+
+
 class DynamicWindowedMemoryNode(MemoryNode):
     """
     Given a string, will return the last n messages until the string is found
@@ -125,15 +339,18 @@ class DynamicWindowedMemoryNode(MemoryNode):
         )
         self.target = target
 
-    def memory(self, state: State) -> list[dict[str, str]]:
+    def memory(self, state: State) -> History:
         """
         Update state history
         """
         history = state.history
-        for i, message in enumerate(history):
-            if eval(self.target, {}, message):
-                history = history[i:]
-                break
+        target = compile_expression(self.target, f"<{self.label} target>")
+        # searched from the end; later turns only check new messages
+        i = history.rfind(
+            f"target:{self.target}", lambda message: eval(target, {}, message)
+        )
+        if i >= 0:
+            history = history[i:]
         return history
 
     def edit_options(self, event):
@@ -2,7 +2,9 @@
 Base class for all nodes
 """
 from typing import TYPE_CHECKING, Any, Optional
+import asyncio
 import tkinter as tk
+import tkinter.scrolledtext
 import os
 from abc import ABC, abstractmethod
 import logging
@@ -17,6 +19,7 @@ if TYPE_CHECKING:
     from promptflow.src.flowchart import Flowchart
     from promptflow.src.connectors.connector import Connector
 
+
 class NodeBase(Serializable, ABC):
     """
     Represents a node in the flowchart, which could be a prompt, an llm, traditional code, etc.
@@ -39,25 +42,43 @@ class NodeBase(Serializable, ABC):
         self.flowchart = flowchart
         self.id: str = kwargs.get("id") or str(uuid.uuid1())
         self.canvas = flowchart.canvas
+        self._label = label
+        self.input_connectors: list[Connector] = []
+        self.output_connectors: list[Connector] = []
+        self.visited = False  # Add a visited attribute to keep track of visited nodes
+        self.center_x = center_x
+        self.center_y = center_y
+        self.item: Optional[int] = None
+        self.label_item: Optional[int] = None
+        self.items: list[int] = []
+        self.buttons: list[customtkinter.CTkButton] = []
+        self.label_entry: Optional[customtkinter.CTkEntry] = None
+
+    @property
+    def is_drawn(self) -> bool:
+        """Whether the node's canvas items have been created"""
+        return self.item is not None
 
+    def draw_view(self):
+        """
+        Create the canvas items and widgets that represent the node.
+        Called by the flowchart when the node is added to a canvas;
+        headless flowcharts never build a view.
+        Subclasses add their own items after calling super().
+        """
+        center_x, center_y = self.center_x, self.center_y
         self.item = self.draw_shape(center_x, center_y)
         self.canvas.tag_bind(self.item, "<ButtonPress-1>", self.start_drag)
         self.canvas.tag_bind(self.item, "<ButtonRelease-1>", self.stop_drag)
         self.canvas.tag_bind(self.item, "<B1-Motion>", self.on_drag)
         # right click menu
         self.canvas.tag_bind(self.item, "<Button-3>", self.show_menu)
-        self._label = label
-        self.input_connectors: list[Connector] = []
-        self.output_connectors: list[Connector] = []
-        self.visited = False  # Add a visited attribute to keep track of visited nodes
 
         # create the label
-        self.center_x = center_x
-        self.center_y = center_y
         self.label_item = self.canvas.create_text(
             center_x,
             center_y,
-            text=label,
+            text=self.label,
             fill="black",
             width=self.size_px * 2,
             justify="center",
@@ -103,8 +124,6 @@ class NodeBase(Serializable, ABC):
 
         self.buttons = [self.delete_button, self.add_connector_button]
 
-        self.label_entry: Optional[customtkinter.CTkEntry] = None
-
     def __eq__(self, __o: object) -> bool:
         if isinstance(__o, NodeBase):
             return self.id == __o.id
@@ -133,7 +152,8 @@ class NodeBase(Serializable, ABC):
     @label.setter
     def label(self, label: str):
         self._label = label
-        self.canvas.itemconfig(self.label_item, text=label, width=self.size_px * 2)
+        if self.is_drawn:
+            self.canvas.itemconfig(self.label_item, text=label, width=self.size_px * 2)
 
     def get_center(
         self, offset_x: float = 0, offset_y: float = 0
@@ -262,6 +282,16 @@ class NodeBase(Serializable, ABC):
         Code that will be run when the node is executed.
         """
 
+    async def arun_subclass(
+        self, before_result: Any, state, console: tk.scrolledtext.ScrolledText
+    ) -> str:
+        """
+        Async version of run_subclass.
+        Defaults to running run_subclass in a worker thread; nodes that wait
+        on the network override this with a native implementation.
+        """
+        return await asyncio.to_thread(self.run_subclass, before_result, state, console)
+
     def before(self, state: State, console: tk.scrolledtext.ScrolledText) -> Any:
         """
         Blocking method called before main node execution.
@@ -280,6 +310,18 @@ class NodeBase(Serializable, ABC):
         state.result = output
         return output
 
+    async def arun_node(
+        self, before_result: Any, state: State, console: tk.scrolledtext.ScrolledText
+    ) -> str:
+        """
+        Async version of run_node
+        """
+        state.snapshot[self.label] = state.snapshot.get(self.label, "")
+        output: str = await self.arun_subclass(before_result, state, console)
+        state.snapshot[self.label] = output
+        state.result = output
+        return output
+
     def serialize(self):
         return {
             "id": self.id,
@@ -306,6 +348,9 @@ class NodeBase(Serializable, ABC):
 
         for button in self.buttons:
             button.destroy()
+        self.item = None
+        self.items = []
+        self.buttons = []
 
     def copy(self) -> "NodeBase":
         """
@@ -313,9 +358,10 @@ class NodeBase(Serializable, ABC):
         """
         self.logger.info(f"Copying node {self.label}")
         data = self.serialize()
-        data["id"] = uuid.uuid4()
+        data["id"] = str(uuid.uuid4())
         data["label"] = f"{data['label']} copy"
         new_node = self.deserialize(self.flowchart, data)
+        self.flowchart.add_node(new_node)
         return new_node
 
     def show_menu(self, event: tk.Event):
@@ -365,6 +411,12 @@ class NodeBase(Serializable, ABC):
         Doesn't do anything by default.
         """
 
+    def finish_run(self):
+        """
+        Called once a run of the flowchart has ended, however it ended,
+        e.g. to save work the node buffered. Does nothing by default.
+        """
+
     def cost(self, state: State) -> float:
         """
         The cost of running this node in dollars.
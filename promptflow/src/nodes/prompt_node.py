@@ -42,9 +42,13 @@ class PromptNode(NodeBase):
         if isinstance(prompt, dict):
             prompt = TextData.deserialize(prompt, self.flowchart)
         self.prompt = prompt
+        self.text_window: Optional[TextInput] = None
+
+    def draw_view(self):
+        super().draw_view()
         self.prompt_item = self.canvas.create_text(
-            center_x,
-            center_y + 30,
+            self.center_x,
+            self.center_y + 30,
             text=self.prompt.label,
             fill="black",
             width=self.size_px * 2,
@@ -52,8 +56,6 @@ class PromptNode(NodeBase):
         )
         self.items.extend([self.prompt_item])
         self.canvas.tag_bind(self.prompt_item, "<Double-Button-1>", self.edit_options)
-
-        self.text_window: Optional[TextInput] = None
         self.bind_drag()
         self.bind_mouseover()
 
@@ -102,5 +104,10 @@ class PromptNode(NodeBase):
         )
 
     def cost(self, state: State):
-        state.result = self.prompt.text
+        try:
+            state.result = self.prompt.text.format(state=state)
+        except (KeyError, IndexError, AttributeError, ValueError):
+            # refers to outputs only known once the flowchart runs
+            state.result = self.prompt.text
+        state.snapshot[self.label] = state.result
         return 0
@@ -24,6 +24,10 @@ class RegexNode(NodeBase):
             **kwargs,
         )
         self.regex = kwargs.get("regex", "")
+        self.options_popup = None
+
+    def draw_view(self):
+        super().draw_view()
         self.regex_item = self.canvas.create_text(
             self.center_x,
             self.center_y + 30,
@@ -37,8 +41,6 @@ class RegexNode(NodeBase):
         self.bind_drag()
         self.bind_mouseover()
 
-        self.options_popup = None
-
     def run_subclass(
         self, before_result: Any, state, console: tkinter.scrolledtext.ScrolledText
     ) -> str:
@@ -72,6 +74,10 @@ class TagNode(NodeBase):
         super().__init__(*args, **kwargs)
         self.start_tag = kwargs.get("start_tag", "")
         self.end_tag = kwargs.get("end_tag", "")
+        self.options_popup = None
+
+    def draw_view(self):
+        super().draw_view()
         self.tags_item = self.canvas.create_text(
             self.center_x,
             self.center_y + 30,
@@ -86,8 +92,6 @@ class TagNode(NodeBase):
         self.bind_drag()
         self.bind_mouseover()
 
-        self.options_popup = None
-
     def run_subclass(
         self, before_result: Any, state, console: tkinter.scrolledtext.ScrolledText
     ) -> str:
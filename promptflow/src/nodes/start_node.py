@@ -28,9 +28,8 @@ class StartNode(NodeBase):
         **kwargs,
     ):
         # make sure there is only one start node
-        for node in flowchart.nodes:
-            if isinstance(node, StartNode):
-                raise ValueError("Only one start node is allowed")
+        if flowchart.start_nodes:
+            raise ValueError("Only one start node is allowed")
 
         super().__init__(flowchart, center_x, center_y, label, **kwargs)
 
@@ -76,9 +75,8 @@ class InitNode(NodeBase):
         **kwargs,
     ):
         # make sure there is only one init node
-        for node in flowchart.nodes:
-            if isinstance(node, InitNode):
-                raise ValueError("Only one init node is allowed")
+        if flowchart.init_nodes:
+            raise ValueError("Only one init node is allowed")
 
         super().__init__(flowchart, center_x, center_y, label, **kwargs)
         self.run_once = False
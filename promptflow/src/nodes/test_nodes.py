@@ -1,7 +1,9 @@
 """
 Nodes for performing tests on the model.
 """
+import builtins
 import tkinter
+from types import MappingProxyType
 from typing import TYPE_CHECKING, Optional, Any
 from promptflow.src.dialogues.node_options import NodeOptions
 from promptflow.src.dialogues.text_input import TextInput
@@ -40,7 +42,12 @@ class AssertNode(NodeBase):
     def run_subclass(
         self, before_result: Any, state, console: tkinter.scrolledtext.ScrolledText
     ) -> str:
-        assert eval(self.assertion.text, globals(), state.snapshot), "Assertion failed"
+        # node outputs are readable by name, but the expression can't write to them
+        assert eval(
+            self.assertion.expression(),
+            {"__builtins__": builtins, "state": state},
+            MappingProxyType(state.snapshot),
+        ), "Assertion failed"
         return state.result
 
     def edit_options(self, event):
@@ -75,6 +82,9 @@ class LoggingNode(NodeBase):
         if debug_str is None:
             debug_str = TextData("Debug String", "{state.result}", self.flowchart)
         self.debug_str = debug_str
+
+    def draw_view(self):
+        super().draw_view()
         self.canvas.tag_bind(self.item, "<Double-Button-1>", self.edit_string)
 
     def run_subclass(
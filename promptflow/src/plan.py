@@ -0,0 +1,146 @@
+"""
+Static analysis of a flowchart's graph, done once before running it.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING, Iterable
+
+from promptflow.src.connectors.connector import Connector, DEFAULT_COND_TEMPLATE
+
+if TYPE_CHECKING:
+    from promptflow.src.flowchart import Flowchart
+    from promptflow.src.nodes.node_base import NodeBase
+
+
+def is_unconditional(connector: Connector) -> bool:
+    """
+    Whether the connector is always followed, so its condition needn't run
+    """
+    text = connector.condition.text.strip()
+    return not text or text == DEFAULT_COND_TEMPLATE.strip()
+
+
+class ExecutionPlan:
+    """
+    The flowchart's graph compiled for running:
+
+    - order: every node reachable from the Start/Init nodes, in topological
+      order of the graph with each loop collapsed to a single step
+    - loops: strongly connected components with a cycle (e.g. chat loops)
+    - acyclic: ids of reachable nodes that are not part of any loop, which
+      run at most once per pass
+    - unreachable: nodes no run can get to
+    - successors: each node's output connectors, split into the children
+      that always follow it and the connectors whose condition must run
+    """
+
+    __slots__ = ("order", "rank", "loops", "acyclic", "unreachable", "successors")
+
+    def __init__(self):
+        self.order: list[NodeBase] = []
+        self.rank: dict[str, int] = {}
+        self.loops: list[list[NodeBase]] = []
+        self.acyclic: set[str] = set()
+        self.unreachable: list[NodeBase] = []
+        self.successors: dict[str, tuple[list[NodeBase], list[Connector]]] = {}
+
+    @classmethod
+    def compile(cls, flowchart: Flowchart) -> ExecutionPlan:
+        """
+        Build the plan for the flowchart's current nodes and connectors
+        """
+        plan = cls()
+        for node in flowchart.nodes:
+            always: list[NodeBase] = []
+            conditional: list[Connector] = []
+            for connector in node.output_connectors:
+                if not is_unconditional(connector):
+                    conditional.append(connector)
+                elif connector.node2 not in always:
+                    always.append(connector.node2)
+            plan.successors[node.id] = (always, conditional)
+
+        # components come out last root first
+        roots = flowchart.start_nodes + flowchart.init_nodes
+        reachable = _reachable(roots)
+        plan.unreachable = [
+            node for node in flowchart.nodes if node.id not in reachable
+        ]
+
+        for component in reversed(_strongly_connected(roots)):
+            node = component[0]
+            if len(component) > 1 or node in node.get_children():
+                plan.loops.append(component)
+            else:
+                plan.acyclic.add(node.id)
+            for member in component:
+                plan.rank[member.id] = len(plan.order)
+                plan.order.append(member)
+        return plan
+
+    def children(self, node: NodeBase) -> tuple[list[NodeBase], list[Connector]]:
+        """
+        Children that always follow the node, and connectors to evaluate
+        """
+        return self.successors.get(node.id, ([], node.output_connectors))
+
+
+def _reachable(roots: Iterable[NodeBase]) -> set[str]:
+    seen: set[str] = set()
+    stack = list(roots)
+    while stack:
+        node = stack.pop()
+        if node.id in seen:
+            continue
+        seen.add(node.id)
+        stack.extend(node.get_children())
+    return seen
+
+
+def _strongly_connected(roots: Iterable[NodeBase]) -> list[list[NodeBase]]:
+    """
+    Tarjan's algorithm over the nodes reachable from roots, iteratively.
+    Components come out in reverse topological order.
+    """
+    index: dict[str, int] = {}
+    lowlink: dict[str, int] = {}
+    on_stack: set[str] = set()
+    stack: list[NodeBase] = []
+    components: list[list[NodeBase]] = []
+
+    for root in roots:
+        if root.id in index:
+            continue
+        work: list[tuple[NodeBase, int]] = [(root, 0)]
+        while work:
+            node, child_i = work.pop()
+            if child_i == 0:
+                index[node.id] = lowlink[node.id] = len(index)
+                stack.append(node)
+                on_stack.add(node.id)
+            children = node.get_children()
+            recursed = False
+            while child_i < len(children):
+                child = children[child_i]
+                child_i += 1
+                if child.id not in index:
+                    work.append((node, child_i))
+                    work.append((child, 0))
+                    recursed = True
+                    break
+                if child.id in on_stack:
+                    lowlink[node.id] = min(lowlink[node.id], index[child.id])
+            if recursed:
+                continue
+            if lowlink[node.id] == index[node.id]:
+                component: list[NodeBase] = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member.id)
+                    component.append(member)
+                    if member is node:
+                        break
+                components.append(component[::-1])
+            if work:
+                parent = work[-1][0]
+                lowlink[parent.id] = min(lowlink[parent.id], lowlink[node.id])
+    return components
@@ -0,0 +1,198 @@
+"""
+Client-side rate limiting for OpenAI calls: requests and tokens per minute,
+per model, shared by every node in the process. Calls wait their turn
+instead of hitting RateLimitError and backing off.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from promptflow.src.tokens import request_prompt_tokens
+
+
+class Limit:
+    """
+    Requests and tokens allowed per minute; None means unlimited
+    """
+
+    __slots__ = ("rpm", "tpm")
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self.rpm = rpm
+        self.tpm = tpm
+
+    def __repr__(self) -> str:
+        return f"Limit(rpm={self.rpm}, tpm={self.tpm})"
+
+
+class _Bucket:
+    """
+    Refills continuously at limit/60 per second, up to one minute's worth.
+    Callers take what they need straight away, possibly going into debt,
+    and wait until the debt is repaid, so they are served in arrival order.
+    """
+
+    __slots__ = ("capacity", "rate", "level", "updated")
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self, amount: float, now: float) -> float:
+        """
+        Take amount and return the seconds to wait before using it
+        """
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= min(amount, self.capacity)
+        return max(-self.level / self.rate, 0.0)
+
+    def give(self, amount: float):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """
+    Tracks requests/minute and tokens/minute for each model.
+    Models without a configured limit use the default, if any.
+    """
+
+    def __init__(
+        self, limits: Optional[dict[str, Limit]] = None, default: Optional[Limit] = None
+    ):
+        self.limits = limits or {}
+        self.default = default
+        self._buckets: dict[tuple[str, str], _Bucket] = {}
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def _bucket(self, model: str, kind: str) -> Optional[_Bucket]:
+        limit = self.limits.get(model, self.default)
+        per_minute = getattr(limit, kind) if limit else None
+        if not per_minute:
+            return None
+        bucket = self._buckets.get((model, kind))
+        if bucket is None:
+            bucket = self._buckets[(model, kind)] = _Bucket(per_minute)
+        return bucket
+
+    def reserve(self, model: str, tokens: int = 0) -> float:
+        """
+        Reserve one request and tokens; returns the seconds to wait before sending
+        """
+        now = time.monotonic()
+        wait = 0.0
+        with self._lock:
+            requests = self._bucket(model, "rpm")
+            if requests:
+                wait = max(wait, requests.take(1, now))
+            token_bucket = self._bucket(model, "tpm")
+            if token_bucket and tokens:
+                wait = max(wait, token_bucket.take(tokens, now))
+        if wait:
+            self.logger.info("Rate limiting %s for %.2fs", model, wait)
+        return wait
+
+    def acquire(self, model: str, tokens: int = 0):
+        """
+        Block until a request using tokens may be sent
+        """
+        wait = self.reserve(model, tokens)
+        if wait:
+            time.sleep(wait)
+
+    async def aacquire(self, model: str, tokens: int = 0):
+        """
+        Async version of acquire
+        """
+        wait = self.reserve(model, tokens)
+        if wait:
+            await asyncio.sleep(wait)
+
+    def settle(self, model: str, reserved: int, used: int):
+        """
+        Return tokens reserved but not used (e.g. max_tokens not generated)
+        """
+        if used >= reserved:
+            return
+        with self._lock:
+            token_bucket = self._bucket(model, "tpm")
+            if token_bucket:
+                token_bucket.give(reserved - used)
+
+
+def request_tokens(request: dict[str, Any]) -> int:
+    """
+    Upper bound on the tokens a completion request will use:
+    the prompt plus max_tokens for each of the n choices
+    """
+    prompts = len(request["prompt"]) if isinstance(request.get("prompt"), list) else 1
+    completion = (request.get("max_tokens") or 16) * request.get("n", 1) * prompts
+    return request_prompt_tokens(request) + completion
+
+
+def _used_tokens(response: Any) -> Optional[int]:
+    if isinstance(response, dict) and response.get("usage"):
+        return response["usage"].get("total_tokens")
+    return None
+
+
+def limited(create: Callable[..., Any], limiter: Optional[RateLimiter]):
+    """
+    Wrap an openai create function so each call waits for the limiter
+    """
+    if limiter is None:
+        return create
+
+    def limited_create(**request: Any) -> Any:
+        model = request.get("model", "")
+        tokens = request_tokens(request)
+        limiter.acquire(model, tokens)
+        response = create(**request)
+        used = _used_tokens(response)
+        if used is not None:
+            limiter.settle(model, tokens, used)
+        return response
+
+    return limited_create
+
+
+def alimited(acreate: Callable[..., Awaitable[Any]], limiter: Optional[RateLimiter]):
+    """
+    Async version of limited
+    """
+    if limiter is None:
+        return acreate
+
+    async def limited_acreate(**request: Any) -> Any:
+        model = request.get("model", "")
+        tokens = request_tokens(request)
+        await limiter.aacquire(model, tokens)
+        response = await acreate(**request)
+        used = _used_tokens(response)
+        if used is not None:
+            limiter.settle(model, tokens, used)
+        return response
+
+    return limited_acreate
+
+
+# process-wide limiter shared by all nodes; None disables limiting
+_limiter: Optional[RateLimiter] = None
+
+
+def set_rate_limiter(limiter: Optional[RateLimiter]):
+    """
+    Limit OpenAI calls from every node in the process, or None to stop
+    """
+    global _limiter  # pylint: disable=global-statement
+    _limiter = limiter
+
+
+def get_rate_limiter() -> Optional[RateLimiter]:
+    return _limiter
@@ -3,10 +3,23 @@ State class definition
 """
 
 from __future__ import annotations
-from typing import Any
+from typing import Any, Iterable
+from promptflow.src.history import History
 from promptflow.src.serializable import Serializable
 
 
+class Choices(list):
+    """
+    Alternative results from one node, e.g. an LLM's n completions.
+    With branch set, the Executor sends each child of the node its own
+    choice, in turn, instead of the whole list.
+    """
+
+    def __init__(self, choices: Iterable[Any] = (), branch: bool = False):
+        super().__init__(choices)
+        self.branch = branch
+
+
 class State(Serializable):
     """
     Holds state for flowchart flow
@@ -15,9 +28,20 @@ class State(Serializable):
 
     def __init__(self, **kwargs):
         self.snapshot: dict[str, str] = kwargs.get("snapshot", {})
-        self.history: list[dict[str, str]] = kwargs.get("history", [])
+        self.history = kwargs.get("history", [])
         self.result: str = kwargs.get("result", "")
 
+    @property
+    def history(self) -> History:
+        """
+        Chat messages so far; a plain list assigned here becomes a History
+        """
+        return self._history
+
+    @history.setter
+    def history(self, messages: list[dict[str, str]]):
+        self._history = messages if isinstance(messages, History) else History(messages)
+
     def __or__(self, __t: dict | State) -> "State":
         if isinstance(__t, dict):
             self.snapshot.update(__t)
@@ -35,6 +59,33 @@ class State(Serializable):
             result=self.result,
         )
 
+    @classmethod
+    def merge(cls, states: list[State]) -> State:
+        """
+        Join the states of branches that ran in parallel.
+        Snapshots are combined in branch order, history keeps the messages
+        the branches share followed by each branch's new messages, and the
+        last branch's result wins.
+        """
+        if len(states) == 1:
+            return states[0]
+        # forked histories share their message dicts up to the fork
+        shared = 0
+        shortest = min(len(state.history) for state in states)
+        while shared < shortest and all(
+            state.history[shared] is states[0].history[shared] for state in states
+        ):
+            shared += 1
+        merged = cls(
+            snapshot={},
+            history=states[0].history[:shared],
+            result=states[-1].result,
+        )
+        for state in states:
+            merged.snapshot.update(state.snapshot)
+            merged.history.extend(state.history[shared:])
+        return merged
+
     @classmethod
     def deserialize(cls, data: dict[str, Any]) -> State:
         return cls(**data)
@@ -0,0 +1,158 @@
+"""
+Delivers LLM output as it is generated, instead of once the node finishes.
+"""
+from __future__ import annotations
+import re
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator
+
+if TYPE_CHECKING:
+    from promptflow.src.nodes.node_base import NodeBase
+
+
+class OutputSink(ABC):
+    """
+    Receives a node's output piece by piece while the node runs
+    """
+
+    @abstractmethod
+    def write(self, node: "NodeBase", text: str):
+        """
+        Called with each new piece of text, in order
+        """
+
+    def close(self, node: "NodeBase"):
+        """
+        Called once the node has produced all of its output
+        """
+
+
+class ConsoleSink(OutputSink):
+    """
+    Writes output to a console (tk text widget or HeadlessConsole) as it arrives.
+    Only use from the thread that owns the console.
+    """
+
+    def __init__(self, console):
+        self.console = console
+        self._open: set[str] = set()
+        self._streamed: set[str] = set()
+
+    def write(self, node: "NodeBase", text: str):
+        if node.id not in self._open:
+            self._open.add(node.id)
+            self._streamed.add(node.id)
+            text = f"{node.label}: {text}"
+        self.console.insert("end", text)
+        self.console.see("end")
+
+    def close(self, node: "NodeBase"):
+        if node.id in self._open:
+            self._open.discard(node.id)
+            self.console.insert("end", "\n")
+            self.console.see("end")
+
+    def pop_streamed(self, node: "NodeBase") -> bool:
+        """
+        Whether the node streamed output here since the last call for it
+        """
+        if node.id in self._streamed:
+            self._streamed.discard(node.id)
+            return True
+        return False
+
+
+class BufferedSink(OutputSink):
+    """
+    Collects output from a worker thread for another thread to drain,
+    e.g. the GUI's event loop
+    """
+
+    def __init__(self):
+        self._parts: list[str] = []
+        self._lock = threading.Lock()
+        self.streamed = False
+
+    def write(self, node: "NodeBase", text: str):
+        with self._lock:
+            if not self.streamed:
+                self.streamed = True
+                text = f"{node.label}: {text}"
+            self._parts.append(text)
+
+    def drain(self) -> str:
+        """
+        Return and forget everything written since the last drain
+        """
+        with self._lock:
+            text = "".join(self._parts)
+            self._parts = []
+        return text
+
+
+class SentenceSink(OutputSink):
+    """
+    Calls callback(node, sentence) for each complete sentence, so a caller's
+    consumer can start before the whole response is ready
+    """
+
+    sentence_end = re.compile(r"(?<=[.!?])\s+")
+
+    def __init__(self, callback: Callable[["NodeBase", str], None]):
+        self.callback = callback
+        self._buffers: dict[str, str] = {}
+
+    def write(self, node: "NodeBase", text: str):
+        buffer = self._buffers.get(node.id, "") + text
+        *sentences, buffer = self.sentence_end.split(buffer)
+        self._buffers[node.id] = buffer
+        for sentence in sentences:
+            if sentence.strip():
+                self.callback(node, sentence.strip())
+
+    def close(self, node: "NodeBase"):
+        rest = self._buffers.pop(node.id, "").strip()
+        if rest:
+            self.callback(node, rest)
+
+
+# sinks receiving output from nodes running in this thread or task
+_sinks: ContextVar[tuple[OutputSink, ...]] = ContextVar("output_sinks", default=())
+
+
+@contextmanager
+def output_to(sinks: Iterable[OutputSink]) -> Iterator[None]:
+    """
+    Send streamed output from nodes run inside the with block to sinks
+    """
+    token = _sinks.set(tuple(sinks))
+    try:
+        yield
+    finally:
+        _sinks.reset(token)
+
+
+def is_streaming() -> bool:
+    """
+    Whether anything is listening for streamed output
+    """
+    return bool(_sinks.get())
+
+
+def emit(node: "NodeBase", text: str):
+    """
+    Pass a piece of a node's output to the current sinks
+    """
+    for sink in _sinks.get():
+        sink.write(node, text)
+
+
+def close(node: "NodeBase"):
+    """
+    Tell the current sinks the node has finished its output
+    """
+    for sink in _sinks.get():
+        sink.close(node)
@@ -1,12 +1,57 @@
 """
 Handles reusable text data in the flowchart
 """
-from typing import TYPE_CHECKING
+import builtins
+import hashlib
+import threading
+from types import CodeType
+from typing import TYPE_CHECKING, Any, Callable
 from promptflow.src.serializable import Serializable
+from promptflow.src.state import State
 
 if TYPE_CHECKING:
     from promptflow.src.flowchart import Flowchart
 
+# compiled namespaces by content hash; old entries are dropped past the limit
+CODE_CACHE_SIZE = 256
+_code_cache: dict[str, dict[str, Any]] = {}
+_code_cache_lock = threading.Lock()
+
+
+def _cache(key: str, value: Any) -> Any:
+    with _code_cache_lock:
+        if len(_code_cache) >= CODE_CACHE_SIZE:
+            del _code_cache[next(iter(_code_cache))]
+        return _code_cache.setdefault(key, value)
+
+
+def compile_code(text: str, filename: str = "<text_data>") -> dict[str, Any]:
+    """
+    Compile and run Python source once, returning the namespace it defined.
+    The namespace is cached by the hash of the source and reused until the
+    source changes. It is private to the source: nothing defined in it
+    leaks into the state.
+    """
+    key = "exec:" + hashlib.sha256(text.encode()).hexdigest()
+    namespace = _code_cache.get(key)
+    if namespace is not None:
+        return namespace
+    code = compile(text, filename, "exec")
+    namespace = {"__builtins__": builtins, "__name__": filename, "State": State}
+    exec(code, namespace)  # pylint: disable=exec-used
+    return _cache(key, namespace)
+
+
+def compile_expression(text: str, filename: str = "<text_data>") -> CodeType:
+    """
+    Compile a Python expression once, cached by the hash of its source
+    """
+    key = "eval:" + hashlib.sha256(text.encode()).hexdigest()
+    code = _code_cache.get(key)
+    if code is not None:
+        return code
+    return _cache(key, compile(text, filename, "eval"))
+
 
 class TextData(Serializable):
     """
@@ -49,6 +94,27 @@ class TextData(Serializable):
         self._text = value
         self.flowchart.register_text_data(self)
 
+    def namespace(self) -> dict[str, Any]:
+        """
+        Globals defined by running the text as Python, compiled once per version of the text
+        """
+        return compile_code(self.text.strip(), self.label)
+
+    def expression(self) -> CodeType:
+        """
+        The text compiled as a single Python expression
+        """
+        return compile_expression(self.text.strip(), self.label)
+
+    def main(self) -> Callable:
+        """
+        The main() function defined by the text
+        """
+        namespace = self.namespace()
+        if "main" not in namespace:
+            raise NameError("Function must have a main() function")
+        return namespace["main"]
+
     def serialize(self) -> dict[str, str]:
         return {
             "label": self.label,
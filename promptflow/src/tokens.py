@@ -0,0 +1,121 @@
+"""
+Token counting shared by cost estimates and rate limiting.
+Encoders are loaded once per process and counts are memoized by text hash.
+"""
+from __future__ import annotations
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import tiktoken
+
+# encoding used for models tiktoken doesn't know
+DEFAULT_ENCODING = "cl100k_base"
+COUNT_CACHE_SIZE = 65536
+# seconds before trying again to load an encoding that failed to load
+RETRY_AFTER = 60.0
+
+# only encodings that loaded, so a failed download is retried
+_encodings: dict[str, tiktoken.Encoding] = {}
+_failures: dict[str, float] = {}
+
+_counts: OrderedDict[tuple[str, bytes], int] = OrderedDict()
+_counts_lock = threading.Lock()
+
+
+def encoding_for_model(model: str) -> Optional[tiktoken.Encoding]:
+    """
+    The model's tiktoken encoding, loaded once per process.
+    None if it can't be loaded (tiktoken downloads encodings on first use);
+    loading is tried again after RETRY_AFTER seconds.
+    """
+    encoding = _encodings.get(model)
+    if encoding is not None:
+        return encoding
+    failed_at = _failures.get(model)
+    if failed_at is not None and time.monotonic() - failed_at < RETRY_AFTER:
+        return None
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as err:  # pylint: disable=broad-except
+        _failures[model] = time.monotonic()
+        logging.getLogger(__name__).warning(
+            "No tiktoken encoding for %s, estimating token counts: %s", model, err
+        )
+        return None
+    _failures.pop(model, None)
+    _encodings[model] = encoding
+    return encoding
+
+
+def count_tokens(model: str, text: str) -> int:
+    """
+    Number of tokens in text for the model
+    """
+    if not text:
+        return 0
+    encoding = encoding_for_model(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    key = (encoding.name, hashlib.blake2b(text.encode(), digest_size=16).digest())
+    with _counts_lock:
+        count = _counts.get(key)
+        if count is not None:
+            _counts.move_to_end(key)
+            return count
+    count = len(encoding.encode(text, disallowed_special=()))
+    with _counts_lock:
+        _counts[key] = count
+        if len(_counts) > COUNT_CACHE_SIZE:
+            _counts.popitem(last=False)
+    return count
+
+
+def _message_overhead(model: str) -> tuple[int, int]:
+    """
+    Tokens added around every chat message, and for a message's name
+    """
+    if model.startswith("gpt-3.5-turbo-0301"):
+        return 4, -1
+    return 3, 1
+
+
+def message_tokens(model: str, message: dict[str, str]) -> int:
+    """
+    Tokens one chat message takes up in a request, role overhead included
+    """
+    tokens_per_message, tokens_per_name = _message_overhead(model)
+    total = tokens_per_message
+    for key, value in message.items():
+        total += count_tokens(model, value)
+        if key == "name":
+            total += tokens_per_name
+    return total
+
+
+def count_message_tokens(model: str, messages: list[dict[str, str]]) -> int:
+    """
+    Tokens a chat request's messages take up, including the per-message
+    role overhead and the tokens priming the assistant's reply
+    https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    """
+    # every reply is primed with <|start|>assistant<|message|>
+    return 3 + sum(message_tokens(model, message) for message in messages)
+
+
+def request_prompt_tokens(request: dict[str, Any]) -> int:
+    """
+    Prompt tokens of a chat or completion request, as sent
+    """
+    model = request.get("model", "")
+    if "messages" in request:
+        return count_message_tokens(model, request["messages"])
+    prompt = request.get("prompt", "")
+    prompts = prompt if isinstance(prompt, list) else [prompt]
+    return sum(count_tokens(model, text) for text in prompts)
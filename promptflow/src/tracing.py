@@ -0,0 +1,151 @@
+"""
+Structured tracing of flowchart runs: a span per node execution
+and per condition evaluation, exportable for offline analysis.
+"""
+from __future__ import annotations
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
+
+
+class Span:
+    """
+    One timed operation, e.g. running a node or evaluating a condition
+    """
+
+    __slots__ = ("name", "category", "start", "end", "thread_id", "attributes", "error")
+
+    def __init__(self, name: str, category: str, attributes: dict[str, Any]):
+        self.name = name
+        self.category = category
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.thread_id = threading.get_ident()
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        """
+        Seconds the span took, or has taken so far
+        """
+        return (self.end or time.perf_counter()) - self.start
+
+    def serialize(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "category": self.category,
+            "start": self.start,
+            "end": self.end,
+            "duration": self.duration,
+            "thread_id": self.thread_id,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+    def __repr__(self) -> str:
+        return f"Span({self.category}, {self.name!r}, {self.duration:.6f}s)"
+
+
+# the span of the node currently running in this thread or task
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def annotate(**attributes: Any):
+    """
+    Attach attributes (e.g. token counts) to the current span, if tracing
+    """
+    span = _current_span.get()
+    if span is not None:
+        span.attributes.update(attributes)
+
+
+class Tracer:
+    """
+    Collects spans from any number of threads or tasks
+    """
+
+    def __init__(self):
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, category: str, **attributes: Any) -> Iterator[Span]:
+        """
+        Time the body of the with block, recording any exception it raises
+        """
+        span = Span(name, category, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as err:
+            span.error = f"{type(err).__name__}: {err}"
+            raise
+        finally:
+            span.end = time.perf_counter()
+            _current_span.reset(token)
+            with self._lock:
+                self.spans.append(span)
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+    def totals(self, key: str = "classname") -> dict[str, float]:
+        """
+        Total seconds spent per value of a span attribute,
+        e.g. per node class, to see where a slow flow spends its time
+        """
+        totals: dict[str, float] = {}
+        for span in list(self.spans):
+            value = str(span.attributes.get(key, span.category))
+            totals[value] = totals.get(value, 0.0) + span.duration
+        return totals
+
+    def export_jsonl(self, filename: str):
+        """
+        Write one JSON object per span
+        """
+        with open(filename, "w", encoding="utf-8") as outfile:
+            for span in list(self.spans):
+                outfile.write(json.dumps(span.serialize(), default=str) + "\n")
+
+    def export_chrome_trace(self, filename: str):
+        """
+        Write the spans in Chrome's trace event format,
+        viewable in chrome://tracing or Perfetto
+        """
+        spans = list(self.spans)
+        origin = min((span.start for span in spans), default=0.0)
+        events = []
+        for span in spans:
+            args = dict(span.attributes)
+            if span.error:
+                args["error"] = span.error
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": (span.start - origin) * 1e6,
+                    "dur": span.duration * 1e6,
+                    "pid": os.getpid(),
+                    "tid": span.thread_id,
+                    "args": args,
+                }
+            )
+        with open(filename, "w", encoding="utf-8") as outfile:
+            json.dump({"traceEvents": events}, outfile, default=str)
+
+    def export(self, filename: str):
+        """
+        Export as a Chrome trace for .json files, JSONL otherwise
+        """
+        if filename.endswith(".json"):
+            self.export_chrome_trace(filename)
+        else:
+            self.export_jsonl(filename)
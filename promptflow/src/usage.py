@@ -0,0 +1,221 @@
+"""
+Token usage and cost of LLM calls: estimates from what a request will
+send, and the usage the API reports, added up per node, run and batch.
+"""
+from __future__ import annotations
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Any, Iterator, Optional
+
+from promptflow.src.tokens import count_tokens, request_prompt_tokens
+
+if TYPE_CHECKING:
+    from promptflow.src.nodes.node_base import NodeBase
+
+# https://openai.com/pricing
+prompt_cost_1k = {
+    "text-davinci-003": 0.02,
+    "gpt-3.5-turbo": 0.002,
+    "gpt-3.5-turbo-0301": 0.002,
+    "gpt-4": 0.03,
+    "gpt-4-0314": 0.03,
+}
+completion_cost_1k = {
+    "text-davinci-003": 0.02,
+    "gpt-3.5-turbo": 0.002,
+    "gpt-3.5-turbo-0301": 0.002,
+    "gpt-4": 0.06,
+    "gpt-4-0314": 0.06,
+}
+# prompt and completion tokens together can't exceed these
+context_window = {
+    "text-davinci-003": 4097,
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-0301": 4096,
+    "gpt-4": 8192,
+    "gpt-4-0314": 8192,
+}
+
+
+def price(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """
+    Dollars charged for the tokens; 0 for models without a known price
+    """
+    return (
+        prompt_cost_1k.get(model, 0.0) * prompt_tokens
+        + completion_cost_1k.get(model, 0.0) * completion_tokens
+    ) / 1000
+
+
+class Usage:
+    """
+    Tokens used and dollars spent by one or more calls
+    """
+
+    __slots__ = ("calls", "prompt_tokens", "completion_tokens", "cost", "cached")
+
+    def __init__(
+        self,
+        calls: int = 0,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        cost: float = 0.0,
+        cached: int = 0,
+    ):
+        self.calls = calls
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cost = cost
+        self.cached = cached
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, other: Usage):
+        self.calls += other.calls
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.cost += other.cost
+        self.cached += other.cached
+
+    def serialize(self) -> dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "cached": self.cached,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "cost": self.cost,
+        }
+
+    def __repr__(self) -> str:
+        return (
+            f"Usage(calls={self.calls}, tokens={self.total_tokens}, "
+            f"cost=${self.cost:.4f})"
+        )
+
+
+def estimate(request: dict[str, Any]) -> Usage:
+    """
+    Usage of a completion request if every choice runs to max_tokens,
+    or to the end of the model's context window if that comes first
+    """
+    model = request.get("model", "")
+    prompt_tokens = request_prompt_tokens(request)
+    prompts = len(request["prompt"]) if isinstance(request.get("prompt"), list) else 1
+    max_tokens = request.get("max_tokens") or 16
+    window = context_window.get(model)
+    if window is not None:
+        max_tokens = min(max_tokens, window - prompt_tokens // prompts)
+    completion_tokens = max(max_tokens, 0) * request.get("n", 1) * prompts
+    return Usage(
+        calls=1,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        cost=price(model, prompt_tokens, completion_tokens),
+    )
+
+
+def response_usage(
+    request: dict[str, Any], response: dict[str, Any], texts: list[str]
+) -> Usage:
+    """
+    Usage of a finished request: what the API reported, or counted from the
+    request and the generated texts when it reported nothing (streamed or
+    micro-batched responses). Responses answered from the cache cost nothing.
+    """
+    model = request.get("model", "")
+    reported = response.get("usage")
+    if reported:
+        prompt_tokens = reported.get("prompt_tokens", 0)
+        completion_tokens = reported.get("completion_tokens", 0)
+    else:
+        prompt_tokens = request_prompt_tokens(request)
+        completion_tokens = sum(count_tokens(model, text) for text in texts)
+    if response.get("cached"):
+        return Usage(calls=1, cached=1)
+    return Usage(
+        calls=1,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        cost=price(model, prompt_tokens, completion_tokens),
+    )
+
+
+class UsageLedger:
+    """
+    Usage recorded per node, e.g. for one run or a whole batch.
+    Safe to record into from any number of threads.
+    """
+
+    def __init__(self):
+        self.nodes: dict[str, Usage] = {}
+        self.labels: dict[str, str] = {}
+        self.models: dict[str, Usage] = {}
+        self._lock = threading.Lock()
+
+    def record(self, node: "NodeBase", model: str, usage: Usage):
+        with self._lock:
+            self.labels[node.id] = node.label
+            self.nodes.setdefault(node.id, Usage()).add(usage)
+            self.models.setdefault(model, Usage()).add(usage)
+
+    def merge(self, other: UsageLedger):
+        """
+        Add another ledger's usage to this one, e.g. a run's to its batch's
+        """
+        with other._lock:
+            nodes = dict(other.nodes)
+            labels = dict(other.labels)
+            models = dict(other.models)
+        with self._lock:
+            self.labels.update(labels)
+            for node_id, usage in nodes.items():
+                self.nodes.setdefault(node_id, Usage()).add(usage)
+            for model, usage in models.items():
+                self.models.setdefault(model, Usage()).add(usage)
+
+    @property
+    def total(self) -> Usage:
+        total = Usage()
+        with self._lock:
+            for usage in self.models.values():
+                total.add(usage)
+        return total
+
+    def serialize(self) -> dict[str, Any]:
+        total = self.total
+        with self._lock:
+            nodes = {
+                node_id: {"label": self.labels[node_id]} | usage.serialize()
+                for node_id, usage in self.nodes.items()
+            }
+            models = {model: usage.serialize() for model, usage in self.models.items()}
+        return {"total": total.serialize(), "nodes": nodes, "models": models}
+
+
+# the ledger nodes running in this thread or task record their usage into
+_ledger: ContextVar[Optional[UsageLedger]] = ContextVar("usage_ledger", default=None)
+
+
+@contextmanager
+def record_to(ledger: Optional[UsageLedger]) -> Iterator[None]:
+    """
+    Record the usage of nodes run inside the with block into ledger
+    """
+    token = _ledger.set(ledger)
+    try:
+        yield
+    finally:
+        _ledger.reset(token)
+
+
+def record(node: "NodeBase", model: str, usage: Usage):
+    """
+    Add a node's usage to the current ledger, if any
+    """
+    ledger = _ledger.get()
+    if ledger is not None:
+        ledger.record(node, model, usage)
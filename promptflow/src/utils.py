@@ -2,6 +2,7 @@
 Utility functions for promptflow.
 """
 
+import asyncio
 import time
 import random
 import logging
@@ -55,3 +56,40 @@ def retry_with_exponential_backoff(
                 raise oai_err
 
     return wrapper
+
+
+def aretry_with_exponential_backoff(
+    func,
+    initial_delay: float = 1,
+    exponential_base: float = 2,
+    jitter: bool = True,
+    max_retries: int = 10,
+    errors: tuple = (
+        openai.error.RateLimitError,  # type: ignore
+        openai.error.ServiceUnavailableError,  # type: ignore
+    ),
+):
+    """Retry a coroutine function with exponential backoff, without blocking the event loop."""
+
+    async def wrapper(*args, **kwargs):
+        num_retries = 0
+        delay = initial_delay
+
+        while True:
+            try:
+                return await func(*args, **kwargs)
+
+            except errors as oai_err:
+                logging.warning(f"Error: {oai_err}. Retrying in {delay} seconds.")
+                num_retries += 1
+
+                if num_retries > max_retries:
+                    raise ConnectionError(
+                        f"Maximum number of retries ({max_retries}) exceeded."
+                    ) from oai_err
+
+                delay *= exponential_base * (1 + jitter * random.random())
+
+                await asyncio.sleep(delay)
+
+    return wrapper